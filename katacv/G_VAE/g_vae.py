@@ -17,6 +17,7 @@ sys.path.append(os.getcwd())
 
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
 from katacv.utils.related_pkgs.utility import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 from katacv.G_VAE.model import TrainState
 from katacv.G_VAE.isda_loss import isda_loss
@@ -107,8 +108,7 @@ if __name__ == '__main__':
       print(f"epoch: {epoch}/{args.total_epochs}")
       print("training...")
       logs.reset()
-      for x, y in tqdm(train_ds, total=train_ds_size):
-        x, y = x.numpy(), y.numpy()
+      for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size):
         global_step += 1
         state, metrics = model_step(state, x, y, train=True)
         logs.update(
@@ -129,8 +129,7 @@ if __name__ == '__main__':
           logs.reset()
       print("validating...")
       logs.reset()
-      for x, y in tqdm(val_ds, total=val_ds_size):
-        x, y = x.numpy(), y.numpy()
+      for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size):
         _, metrics = model_step(state, x, y, train=False)
         logs.update(
           ['loss_val', 'loss_img_val', 'loss_kl_val', 'loss_cls_val', 'acc_val', 'epoch', 'learning_rate'],
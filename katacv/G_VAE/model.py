@@ -15,6 +15,7 @@ sys.path.append(os.getcwd())
 from typing import Any
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
 from katacv.utils.related_pkgs.utility import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 class ConvBlock(nn.Module):
   filters: int
@@ -205,9 +206,8 @@ def test_classify_mnist():
     print(f"epoch: {epoch+1}/{args.total_epochs}:")
     print("training...")
     mean_loss, mean_acc = 0, 0
-    bar = tqdm(ds_train, total=ds_train_size)
+    bar = tqdm(DevicePrefetcher(ds_train), total=ds_train_size)
     for i, (x, y) in enumerate(bar):
-      x, y = x.numpy(), y.numpy()
       state, loss, acc = model_step(state, x, y, train=True)
       mean_loss += (loss - mean_loss) / (i+1)
       mean_acc += (acc - mean_acc) / (i+1)
@@ -215,9 +215,8 @@ def test_classify_mnist():
 
     print("evaluating...")
     mean_loss, mean_acc = 0, 0
-    bar = tqdm(ds_val, total=ds_val_size)
+    bar = tqdm(DevicePrefetcher(ds_val), total=ds_val_size)
     for i, (x, y) in enumerate(bar):
-      x, y = x.numpy(), y.numpy()
       _, loss, acc = model_step(state, x, y, train=False)
       mean_loss += (loss - mean_loss) / (i+1)
       mean_acc += (acc - mean_acc) / (i+1)
@@ -27,6 +27,7 @@ import optax
 from tensorboardX import SummaryWriter
 from argparse import ArgumentParser
 from katacv.utils.logs import Logs, MeanMetric
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 logs = Logs(
     init_logs={
@@ -186,10 +187,10 @@ def train(state, save_id):
         print(f"epoch: {epoch}/{args.total_epochs}")
         logs.reset()
         print("training...")
-        for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
+        for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
         # for x, y in tqdm(train_ds.take(300), total=300, desc="Processing"):
             global_step += 1
-            state, *metrics = model_step(state, x.numpy(), y.numpy(), train=True)
+            state, *metrics = model_step(state, x, y, train=True)
             logs.update(
                 ['loss_train', 'accuracy_top1_train', 'accuracy_top5_train'],
                 metrics
@@ -204,11 +205,11 @@ def train(state, save_id):
 
         print("validating...")
         for x, y in tqdm(
-            val_ds.take(args.val_sample_batch),
+            DevicePrefetcher(val_ds.take(args.val_sample_batch)),
             total=args.val_sample_batch,
             desc="Processing"
         ):
-            _, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+            _, *metrics = model_step(state, x, y, train=False)
             logs.update(
                 ['loss_val', 'accuracy_top1_val', 'accuracy_top5_val', 'epoch'],
                 metrics + [epoch]
@@ -231,10 +232,10 @@ def evaluate():
             name='train',
             global_step=global_step
         ):
-        for x, y in tqdm(ds, total=ds_size, desc="Processing"):
+        for x, y in tqdm(DevicePrefetcher(ds), total=ds_size, desc="Processing"):
         # for x, y in tqdm(train_ds.take(300), total=300, desc="Processing"):
             global_step += 1
-            _, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+            _, *metrics = model_step(state, x, y, train=False)
             logs.update(
                 [f'loss_{name}', f'accuracy_top1_{name}', f'accuracy_top5_{name}'],
                 metrics
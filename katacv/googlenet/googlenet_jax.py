@@ -21,6 +21,7 @@ import optax
 from tensorboardX import SummaryWriter
 from argparse import ArgumentParser
 from katacv.utils.logs import Logs, MeanMetric
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 logs = Logs(
     init_logs={
@@ -246,10 +247,10 @@ if __name__ == '__main__':
         print(f"epoch: {epoch}/{args.total_epochs}")
         logs.reset()
         print("training...")
-        for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
+        for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
         # for x, y in tqdm(train_ds.take(300), total=300, desc="Processing"):
             global_step += 1
-            state, *metrics = model_step(state, x.numpy(), y.numpy())
+            state, *metrics = model_step(state, x, y)
             logs.update(
                 ['loss_train', 'accuracy_top1_train', 'accuracy_top5_train', 'SPS', 'SPS_avg'],
                 metrics
@@ -265,11 +266,11 @@ if __name__ == '__main__':
         logs.reset()
         print("validating...")
         for x, y in tqdm(
-            val_ds.take(args.val_sample_batch),
+            DevicePrefetcher(val_ds.take(args.val_sample_batch)),
             total=args.val_sample_batch,
             desc="Processing"
         ):
-            state, *metrics = model_step(state, x.numpy(), y.numpy())
+            state, *metrics = model_step(state, x, y)
             logs.update(
                 ['loss_val', 'accuracy_top1_val', 'accuracy_top5_val', 'epoch'],
                 metrics + [epoch]
@@ -15,6 +15,7 @@ sys.path.append(os.getcwd())
 
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
 from katacv.utils.related_pkgs.utility import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 from katacv.ocr.cnn_model import TrainState
 from ctc_loss.ctc_loss import ctc_loss
@@ -64,7 +65,7 @@ def calc_accuracy(y, acc_params, max_len):
         seq = pred_idxs[i][mask[i]]
         N = min(max_len, seq.size)
         y_pred[i,:N] = seq[:N]
-    acc = np.mean((y_pred == y).all(-1))
+    acc = np.mean((y_pred == np.asarray(y)).all(-1))
     return acc
 
 if __name__ == '__main__':
@@ -107,8 +108,7 @@ if __name__ == '__main__':
             print(f"epoch: {epoch}/{args.total_epochs}")
             print("training...")
             logs.reset()
-            for x, y in tqdm(train_ds, total=train_ds_size):
-                x, y = x.numpy(), y.numpy()
+            for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size):
                 global_step += 1
                 state, acc_params, loss = model_step(state, x, y, train=True)
                 acc = calc_accuracy(y, jax.device_get(acc_params), args.max_label_length)
@@ -130,8 +130,7 @@ if __name__ == '__main__':
                     logs.reset()
             print("validating...")
             logs.reset()
-            for x, y in tqdm(val_ds, total=val_ds_size):
-                x, y = x.numpy(), y.numpy()
+            for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size):
                 _, acc_params, loss = model_step(state, x, y, train=False)
                 acc = calc_accuracy(y, jax.device_get(acc_params), args.max_label_length)
                 logs.update(
@@ -13,6 +13,7 @@ import sys, os
 sys.path.append(os.getcwd())
 
 from katacv.utils.related_pkgs.utility import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *  # jax, jnp, flax, nn, train_state, optax
 
 ModuleDef = Any
@@ -237,10 +238,10 @@ if __name__ == '__main__':
             print(f"epoch: {epoch}/{args.total_epochs}")
             logs.reset()
             print("training...")
-            for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
+            for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
             # for x, y in tqdm(train_ds.take(300), total=300, desc="Processing"):
                 global_step += 1
-                state, *metrics = model_step(state, x.numpy(), y.numpy())
+                state, *metrics = model_step(state, x, y)
                 logs.update(
                     ['loss_train', 'accuracy_top1_train', 'accuracy_top5_train'],
                     metrics
@@ -259,8 +260,8 @@ if __name__ == '__main__':
 
             logs.reset()
             print("validating...")
-            for x, y in tqdm(val_ds, total=val_ds_size, desc="Processing"):
-                state, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+            for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size, desc="Processing"):
+                state, *metrics = model_step(state, x, y, train=False)
                 logs.update(
                     ['loss_val', 'accuracy_top1_val', 'accuracy_top5_val', 'epoch', 'learning_rate'],
                     metrics + [epoch, args.learning_rate_fn(state.step)]
@@ -275,9 +276,9 @@ if __name__ == '__main__':
                 save_id += 1
     elif args.evaluate:
         print("evaluate on train dataset:")
-        for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
+        for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
             global_step += 1
-            state, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+            state, *metrics = model_step(state, x, y, train=False)
             logs.update(
                 ['loss_train', 'accuracy_top1_train', 'accuracy_top5_train'],
                 metrics
@@ -290,8 +291,8 @@ if __name__ == '__main__':
                 logs.start_time = time.time()
                 logs.writer_tensorboard(writer, global_step)
         print("evaluate on val dataset:")
-        for x, y in tqdm(val_ds, total=val_ds_size, desc="Processing"):
-            state, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+        for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size, desc="Processing"):
+            state, *metrics = model_step(state, x, y, train=False)
             logs.update(
                 ['loss_val', 'accuracy_top1_val', 'accuracy_top5_val'],
                 metrics
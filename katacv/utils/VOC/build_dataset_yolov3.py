@@ -203,16 +203,18 @@ def split_targets(y: tf.Tensor, args: YOLOv3Args):
     Inputs:
         Reshape the y of dataset to the list, include `len(args.split_sizes)` element.
         - `args`: The arguments with `split_sizes` and `anchor_per` variable.
-        - `y`: The label of the dataset's example.
+        - `y`: The label of the dataset's example, \
+            `tf.Tensor` is converted to numpy, the others (e.g. the jax array on device) are kept.
 
     Return:
         Let `N` be the batch size.
         The output's shape is `(N,S,S,anchor_per,6) for S in split_sizes`
     """
+    if isinstance(y, tf.Tensor): y = y.numpy()
     targets, last_idx = [], 0
     for S in args.split_sizes:
         now_idx = last_idx + S*S*args.B
-        targets.append(y[:,last_idx:now_idx,:].numpy().reshape(-1,S,S,args.B,6))
+        targets.append(y[:,last_idx:now_idx,:].reshape(-1,S,S,args.B,6))
         last_idx = now_idx
     return targets
 
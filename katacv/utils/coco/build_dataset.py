@@ -21,6 +21,7 @@ import cv2
 import numpy as np
 from PIL import Image
 import warnings
+from katacv.utils.image_decoder import decode_image
 
 class YOLODataset(Dataset):
   args: YOLOv4Args
@@ -57,7 +58,11 @@ class YOLODataset(Dataset):
   
   def _load_data(self, index):
     path_image = self.args.path_dataset.joinpath(self.path_images[index])
-    image = np.array(Image.open(path_image).convert("RGB"))
+    # Without mosaic, decode at reduced resolution (the long side stays at least 1.1x the final size)
+    # if the image is at least 2 times larger than that. Mosaic keeps the origin size, since it crops
+    # the tiles in pixels and a smaller image would change the relative scale of the tiles.
+    max_size = None if self.use_mosaic4 else int(max(self.args.image_shape[:2]) * 1.1)
+    image, (h0, w0) = decode_image(path_image, max_size=max_size)
     path_bboxes = self.args.path_dataset.joinpath(self.path_bboxes[index])
     with warnings.catch_warnings():
       warnings.simplefilter("ignore")
@@ -65,6 +70,9 @@ class YOLODataset(Dataset):
     if len(bboxes):
       # bboxes parameters: (x, y, w, h, class_id)
       bboxes = np.roll(bboxes.reshape(-1, 5), -1, axis=1)
+      if image.shape[:2] != (h0, w0):
+        bboxes[:,[0,2]] *= image.shape[1] / w0
+        bboxes[:,[1,3]] *= image.shape[0] / h0
     bboxes = self._check_bbox_need_placeholder(bboxes)
     bboxes = bboxes[(bboxes[:,2]>0)&(bboxes[:,3]>0)]  # avoid 0 wide for two data in COCO
     return image, bboxes
@@ -29,20 +29,29 @@ Result:
   
   Also create `label2name.py` file in current script folder.
 
+Packed mode (`--mode packed`):
+  Create one file `{subset}_annotation.npz` for each subset in `path_dataset` (no bbox files), \
+  see `katacv/utils/yolo/annotation.py`, the subsets are processed in parallel and \
+  the JSON is streamed by `ijson` if it is installed.
+
 '''
 import json
 from pathlib import Path
 from tqdm import tqdm
 import math
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 # path_dataset = Path('/home/wty/Coding/datasets/coco')
 path_dataset = Path('/home/yy/Coding/datasets/coco')
 # path_dataset = Path('/media/yy/Data/dataset/COCO')
 path_annotation = path_dataset.joinpath("annotations")
 path_bboxes = path_dataset.joinpath("bboxes")
-path_bboxes.mkdir(exist_ok=True)
+path_constant = Path(__file__).parent.joinpath("constant.py")
 
 def make_bboxes_files(subset="train"):
+  path_bboxes.mkdir(exist_ok=True)
   path_instance = path_annotation.joinpath(f"instances_{subset}2017.json")
   print("Loading JSON file...")
   with open(path_instance, 'r') as file:
@@ -79,17 +88,77 @@ def make_bboxes_files(subset="train"):
   file_annotation.close()
   print(f"Data size of {subset}: {datasize}")
   print(f"Maximum number of {subset} bounding boxes: {max_num_bboxes}")
-  with open("./constant.py", 'w') as file:
+  with open(path_constant, 'w') as file:
     file.write("label2name = {\n")
     for id, name in id2name.items():
       file.write(f"  {id}: '{name}',\n")
     file.write("}\n")
   return datasize, max_num_bboxes
 
+def load_instance_columns(path_instance: Path):
+  """
+  Load the needed columns of the COCO instances JSON as numpy arrays, \
+  stream the JSON by `ijson` (lower memory) if it is installed.
+  """
+  try:
+    import ijson
+  except ImportError:
+    ijson = None
+  instances = None
+  if ijson is None:  # parse the whole file only once
+    with open(path_instance, 'r') as file:
+      instances = json.load(file)
+  def items(prefix):
+    if instances is not None:
+      yield from instances[prefix]
+      return
+    with open(path_instance, 'rb') as file:
+      yield from ijson.items(file, f"{prefix}.item", use_float=True)
+  images = [(x['id'], x['height'], x['width']) for x in items('images')]
+  annotations = [(x['image_id'], x['category_id'], *x['bbox']) for x in items('annotations')]
+  categories = [(x['id'], x['name']) for x in items('categories')]
+  return (
+    np.array(images, np.int64).reshape(-1, 3),
+    np.array(annotations, np.float64).reshape(-1, 6),
+    categories,
+  )
+
+def make_packed_annotation(subset="train"):
+  """Write all the boxes of `subset` into one `{subset}_annotation.npz` file."""
+  from katacv.utils.yolo.annotation import save_annotation
+  images, annotations, categories = load_instance_columns(path_annotation.joinpath(f"instances_{subset}2017.json"))
+  images = images[np.argsort(images[:,0], kind='stable')]
+  category_ids = np.array([c[0] for c in categories])
+  category_order = np.argsort(category_ids)  # label is the index in categories
+  # group the boxes by image, keep the order of annotations in each image
+  ann_img = annotations[:,0].astype(np.int64)
+  order = np.argsort(ann_img, kind='stable')
+  ann_img, annotations = ann_img[order], annotations[order]
+  if len(images):
+    offsets = np.searchsorted(ann_img, np.append(images[:,0], images[-1,0] + 1))
+  else:
+    offsets = np.zeros(1, np.int64)
+  cls = category_order[np.searchsorted(category_ids[category_order], annotations[:,1])]  # category id -> label
+  box = np.concatenate([annotations[:,2:6], cls[:,None]], -1)  # (x,y,w,h,cls)
+  paths_img = [f"./{subset}2017/{image_id:012}.jpg" for image_id in images[:,0]]
+  save_annotation(path_dataset.joinpath(f"{subset}_annotation.npz"), paths_img, box, offsets, images[:,1:3])
+  max_num_bboxes = int(np.diff(offsets).max(initial=0))
+  print(f"Data size of {subset}: {len(images)}")
+  print(f"Maximum number of {subset} bounding boxes: {max_num_bboxes}")
+  return len(images), max_num_bboxes
+
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--mode", default='txt', choices=['txt', 'packed'],
+    help="'txt' writes one bbox file for each image, 'packed' writes one `{subset}_annotation.npz` for each subset.")
+  args = parser.parse_args()
+  if args.mode == 'packed':
+    with ProcessPoolExecutor(2) as pool:
+      list(pool.map(make_packed_annotation, ['val', 'train']))
+    exit()
   datasize_val, max_num_bboxes_val = make_bboxes_files(subset='val')
   datasize_train, max_num_bboxes_train = make_bboxes_files(subset='train')
-  with open("./constant.py", 'a') as file:
+  with open(path_constant, 'a') as file:
     file.write(f"MAX_NUM_BBOXES_TRAIN = {max_num_bboxes_train}\n")
     file.write(f"DATASIZE_TRAIN = {datasize_train}\n")
     file.write(f"MAX_NUM_BBOXES_VAL = {max_num_bboxes_val}\n")
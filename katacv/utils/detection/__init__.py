@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import numpy as np
 import jax, jax.numpy as jnp
+import math
 
 def plot_box(ax: plt.Axes, image_shape: tuple[int], box_params: tuple[float] | np.ndarray, text="", fontsize=8, box_color='red'):
     """
@@ -138,8 +139,8 @@ def iou(
     if box2.ndim == 1: box2 = box2.reshape(1,-1)
     assert(box1.shape[-1] == box2.shape[-1])
     if box1.shape[-1] == 2:
-        box1 = jnp.pad(box1, ((0,0), (2,0)))
-        box2 = jnp.pad(box2, ((0,0), (2,0)))
+        box1 = jnp.pad(box1, [(0,0)] * (box1.ndim-1) + [(2,0)])
+        box2 = jnp.pad(box2, [(0,0)] * (box2.ndim-1) + [(2,0)])
     assert(box1.shape[-1] == 4)
 
     if scale is not None:
@@ -181,6 +182,28 @@ def iou(
     if keepdim: ret = ret[...,None]
     return ret
 
+@partial(jax.jit, static_argnums=[2,3])
+def iou_pairwise(boxes1, boxes2, format='iou', block_size=None):
+    """
+    (JAX) Calculate the pairwise IOU of `boxes1` and `boxes2` by broadcasting in one fused op.
+    @params::`boxes1.shape=(N,4), boxes2.shape=(M,4)` (or `(N,2), (M,2)` for `(w,h)`).
+    @params::`format` = `iou` or `diou` or `ciou`
+    @params::`block_size`: If not `None` and `N > block_size`, split `boxes1` into \
+        blocks with `block_size` rows and compute them one by one by `jax.lax.map`, \
+        the peak memory is bounded by `(block_size,M)`.
+    @return::`shape=(N,M)`, the `(i,j)` element of the return matrix is the IOU of `boxes1[i]` and `boxes2[j]`.
+    """
+    N, M = boxes1.shape[0], boxes2.shape[0]
+    if block_size is None or N <= block_size:
+        return iou(boxes1[:,None,:], boxes2[None,:,:], format)
+    nb = (N + block_size - 1) // block_size
+    boxes1 = jnp.pad(boxes1, ((0, nb * block_size - N), (0, 0)))
+    result = jax.lax.map(
+        lambda b: iou(b[:,None,:], boxes2[None,:,:], format),
+        boxes1.reshape(nb, block_size, -1)
+    )
+    return result.reshape(-1, M)[:N]
+
 @partial(jax.jit, static_argnums=[2])
 def iou_multiply(boxes1, boxes2, format='iou'):
     """
@@ -189,12 +212,7 @@ def iou_multiply(boxes1, boxes2, format='iou'):
     @params::`format` = `iou` or `diou` or `ciou`
     @return::`shape=(N,M)`, the `(i,j)` element of the return matrix is the IOU of `boxes1[i]` and `boxes2[j]`.
     """
-    _, result = jax.lax.scan(
-        f=lambda carry, x: (carry, iou(x, carry, format)),
-        init=boxes2,
-        xs=boxes1
-    )
-    return result
+    return iou_pairwise(boxes1, boxes2, format)
 
 @partial(jax.jit, static_argnums=[3,4])
 def nms_boxes_and_mask_old(boxes, iou_threshold=0.3, conf_threshold=0.2, max_num_box=100, B=3, iou_format='iou'):
@@ -222,8 +240,8 @@ def nms_boxes_and_mask_old(boxes, iou_threshold=0.3, conf_threshold=0.2, max_num
     mask = (boxes[:,0] > conf_threshold) & (~jnp.diagonal(jnp.tri(M,k=-1) @ (ious > iou_threshold)).astype('bool'))
     return boxes, mask
 
-@partial(jax.jit, static_argnums=[3,4,5])
-def nms(box, iou_threshold=0.3, conf_threshold=0.2, nms_multi=30, max_num_box=100, iou_format='iou'):
+@partial(jax.jit, static_argnums=[3,4,5,6])
+def nms(box, iou_threshold=0.3, conf_threshold=0.2, nms_multi=30, max_num_box=100, iou_format='iou', class_aware=False):
   """
   Compute the predicted bounding boxes and the number of bounding boxes.
   
@@ -234,19 +252,78 @@ def nms(box, iou_threshold=0.3, conf_threshold=0.2, nms_multi=30, max_num_box=10
     max_num_box: The maximum number of the bounding boxes.
     iou_format: The format of IOU is used in calculating IOU threshold.
     nms_multi: `max_num_box * num_multi` is the pre box number for iou calculation.
+    class_aware: If taggled, only the boxes with the same class (`box[:,5]`) \
+      can suppress each other, all the classes are suppressed in the same loop.
   
   Return:
     box: The bounding boxes after NMS.  [shape=(max_num_box, 6)]
     pnum: The number of the predicted bounding boxes. [int]
+
+  Note:
+    Exact greedy suppression: each loop keeps the remaining box with the highest \
+    confidence and only removes the boxes overlapping with it, so suppressed boxes \
+    never suppress others. Each loop only computes one IOU row `(M,)`, \
+    and the loop stops after `max_num_box` boxes are kept, time complex: O(max_num_box * M).
   """
   M = min(max_num_box * nms_multi, box.shape[0])  # BUG FIX: The M must bigger than max_num_box, since iou threshold will remove many boxes beside.
-  sort_idxs = jnp.argsort(-box[:,4])[:M]  # only consider the first `max_num_box`
+  _, sort_idxs = jax.lax.top_k(box[:,4], M)  # only consider the first `M`
   box = box[sort_idxs]
-  ious = iou_multiply(box[:,:4], box[:,:4], format=iou_format)
-  mask = (box[:,4] > conf_threshold) & (~jnp.diagonal(jnp.tri(M,k=-1) @ (ious > iou_threshold)).astype('bool'))
-  idx = jnp.argwhere(mask, size=max_num_box, fill_value=-1)[:,0]  # nonzeros
+  remain = box[:,4] > conf_threshold
+  idx = jnp.full((max_num_box,), -1, dtype=jnp.int32)
+  def cond_fn(value):
+    k, remain, _ = value
+    return (k < max_num_box) & remain.any()
+  def body_fn(value):  # keep the first remain box, suppress the overlapping boxes
+    k, remain, idx = value
+    i = jnp.argmax(remain)
+    idx = idx.at[k].set(i)
+    ious = iou(box[i,:4], box[:,:4], format=iou_format)
+    if class_aware:
+      ious = jnp.where(box[:,5] == box[i,5], ious, 0.0)
+    remain = remain & (ious <= iou_threshold)
+    remain = remain.at[i].set(False)
+    return k + 1, remain, idx
+  pnum, _, idx = jax.lax.while_loop(cond_fn, body_fn, (0, remain, idx))
   dbox = box[idx]
-  pnum = (idx != -1).sum()
+  return dbox, pnum
+
+@partial(jax.jit, static_argnums=[2,3,4,5,6,7])
+def nms_matrix(box, conf_threshold=0.2, nms_multi=30, max_num_box=100, iou_format='iou', class_aware=False, kernel='gaussian', sigma=2.0):
+  """
+  (JAX) Matrix NMS (https://arxiv.org/pdf/2003.10152.pdf), decay the confidence \
+  of all the boxes in one parallel pass, without the sequential dependency in greedy NMS.
+  
+  Args:
+    box: The predicted result by the model.  [shape=(N,6), elem=(x,y,w,h,conf,cls)]
+    conf_threshold: The confidence threshold after decaying.
+    nms_multi: `max_num_box * num_multi` is the pre box number for iou calculation.
+    max_num_box: The maximum number of the bounding boxes.
+    iou_format: The format of IOU is used in calculating decay coef.
+    class_aware: If taggled, only the boxes with the same class decay each other.
+    kernel: The decay function of the IOU. ['gaussian' or 'linear']
+    sigma: The coef of the gaussian kernel, `decay = exp(-sigma * (iou^2 - comp^2))` (same as SOLOv2).
+  
+  Return:
+    box: The bounding boxes after NMS, confidence is replaced by the decayed one.  [shape=(max_num_box, 6)]
+    pnum: The number of the predicted bounding boxes. [int]
+  """
+  assert(kernel in ['gaussian', 'linear'])
+  M = min(max_num_box * nms_multi, box.shape[0])
+  _, sort_idxs = jax.lax.top_k(box[:,4], M)
+  box = box[sort_idxs]
+  ious = jnp.triu(iou_multiply(box[:,:4], box[:,:4], format=iou_format), k=1)  # ious[i,j], i < j
+  if class_aware:
+    ious = ious * (box[:,5][:,None] == box[:,5][None,:])
+  comp = ious.max(0)[:,None]  # the maximum IOU of box[i] with the higher confidence boxes
+  if kernel == 'gaussian':
+    decay = jnp.exp(-sigma * (ious ** 2 - comp ** 2))
+  else:
+    decay = (1 - ious) / (1 - comp + 1e-6)
+  conf = box[:,4] * decay.min(0)
+  keep = conf > conf_threshold
+  _, idx = jax.lax.top_k(jnp.where(keep, conf, -1.0), max_num_box)
+  pnum = jnp.minimum(keep.sum(), max_num_box)
+  dbox = box[idx].at[:,4].set(conf[idx])
   return dbox, pnum
 
 @partial(jax.jit, static_argnums=[3,4,5])
@@ -340,43 +417,68 @@ def nms_old(boxes, iou_threshold=0.3, conf_threshold=0.2):
         
     return np.array(boxes_after_nms)
 
+def mAP_multi_threshold(boxes, target_boxes, iou_thresholds):
+    """
+    (Numpy) Calculate the mAP (AP: area under PR curve) of the boxes and the target_boxes \
+    for all the iou thresholds at once.
+    @params::boxes.shape=(N,6) and last dim is (c,x,y,w,h,cls).
+    @params::target_boxes.shape=(M,6) and last dim is (c,x,y,w,h,cls).
+    @params::iou_thresholds.shape=(K,)
+    @return::mAP for each iou threshold, `shape=(K,)`.
+    @speed up::Only one IOU matrix `(N,M)` is calculated, the greedy matching \
+        (by decreasing confidence, the first unused target with the same class) \
+        only loops over the predicted boxes for all the thresholds together, \
+        and AP of each class is given by the segmented cumulative sums.
+    """
+    boxes, target_boxes = np.asarray(boxes), np.asarray(target_boxes)
+    thre = np.asarray(iou_thresholds, dtype=np.float32).reshape(-1)
+    K = thre.size
+    classes, num_target = np.unique(target_boxes[:,5], return_counts=True)
+    if classes.size == 0: return np.full(K, np.nan)
+    boxes = boxes[np.isin(boxes[:,5], classes)]
+    boxes = boxes[np.argsort(boxes[:,0], kind='stable')[::-1]]  # decrease by confidence
+    N = boxes.shape[0]
+    if N == 0: return np.zeros(K)
+    M = target_boxes.shape[0]
+    pad = lambda x: np.pad(x, ((0, 2 ** math.ceil(math.log2(x.shape[0])) - x.shape[0]), (0, 0)))  # avoid recompiling for each shape
+    ious = np.asarray(iou_multiply(pad(boxes[:,1:5]), pad(target_boxes[:,1:5])))[:N,:M]  # (N,M)
+    same = boxes[:,5][:,None] == target_boxes[:,5][None,:]
+    match = (ious[None,...] > thre[:,None,None]) & same[None,...]  # (K,N,M)
+    used, tp, rk = np.zeros((K, M), np.bool_), np.zeros((K, N), np.bool_), np.arange(K)
+    for i in range(N):
+        avail = match[:,i] & (~used)
+        j = avail.argmax(1)  # the first available target box
+        tp[:,i] = avail[rk, j]
+        used[rk[tp[:,i]], j[tp[:,i]]] = True
+    # Segmented cumulative sums for each class
+    sort_i = np.argsort(boxes[:,5], kind='stable')  # keep confidence order in each class
+    pcls, tp = boxes[sort_i,5], tp[:,sort_i]
+    start = np.searchsorted(pcls, pcls, side='left')  # the first index of the class segment
+    first = start == np.arange(N)
+    tpc = np.cumsum(tp, 1)
+    tpc = tpc - (tpc[:,start] - tp[:,start])
+    ci = np.searchsorted(classes, pcls)
+    p = tpc / (np.arange(N) - start + 1)
+    r = tpc / num_target[ci]
+    last_p = np.where(first, 1.0, np.roll(p, 1, axis=1))
+    last_r = np.where(first, 0.0, np.roll(r, 1, axis=1))
+    AP = np.zeros((K, classes.size))
+    np.add.at(AP, (rk[:,None], ci[None,:]), (last_p + p) * (r - last_r) / 2)
+    return AP.sum(1) / classes.size
+
 def mAP(boxes, target_boxes, iou_threshold=0.5):
     """
     Calculate the mAP (AP: area under PR curve) of the boxes and the target_boxes with the iou threshold.
     @params::boxes.shape=(N,6) and last dim is (c,x,y,w,h,cls).
     @params::target_boxes.shape=(N,6) and last dim is (c,x,y,w,h,cls).
     """
-    classes = jnp.unique(target_boxes[:,5])
-    APs = 0
-    for cls in classes:
-        p, r = 1.0, 0.0  # update
-        if (boxes[:,5]==cls).sum() == 0: continue
-        box1 = boxes[boxes[:,5]==cls]
-        sorted_idxs = jnp.argsort(box1[:,0])[::-1]  # use argsort at conf, don't use sort!
-        box1 = box1[sorted_idxs]
-        box2 = target_boxes[target_boxes[:,5]==cls]
-        TP, FP, FN, AP = 0, 0, box2.shape[0], 0
-        used = [False for _ in range(box2.shape[0])]
-        for i in range(box1.shape[0]):
-            match = False
-            for j in range(box2.shape[0]):
-                if used[j] or iou(box1[i,1:5], box2[j,1:5])[0] <= iou_threshold: continue
-                TP += 1; FN -= 1; used[j] = True; match = True
-                break
-            if not match: FP += 1
-            last_p, p, last_r, r = p, TP/(TP+FP), r, TP/(TP+FN)
-            AP += (last_p + p) * (r - last_r) / 2
-        APs += AP
-    return APs / classes.size
+    return mAP_multi_threshold(boxes, target_boxes, [iou_threshold])[0]
 
 def coco_mAP(boxes, target_boxes):
     """
     Calculate the mAP with iou threshold [0.5,0.55,0.6,...,0.9,0.95]
     """
-    ret = 0
-    for iou_threshold in 0.5+jnp.arange(10)*0.05:
-        ret += mAP(boxes, target_boxes, iou_threshold)
-    return ret / 10
+    return mAP_multi_threshold(boxes, target_boxes, 0.5+jnp.arange(10)*0.05).mean()
 
 def get_best_boxes_and_classes(cells, B, C):
     """
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : test_nms.py
+@Desc    :
+Compare `nms` and `nms_matrix` with the plain numpy loops of the same definition.
+Run: python -m pytest katacv/utils/detection/test_nms.py
+'''
+import numpy as np
+import jax.numpy as jnp
+import pytest
+
+from katacv.utils.detection import nms, nms_matrix, iou
+
+def random_box(rng, N, num_classes=3, size=100):
+  """Clustered boxes, so many of them overlap. [shape=(N,6), elem=(x,y,w,h,conf,cls)]"""
+  centers = rng.uniform(0, size, (max(N // 8, 1), 2))
+  xy = centers[rng.integers(0, len(centers), N)] + rng.normal(0, 3, (N, 2))
+  wh = rng.uniform(5, 20, (N, 2))
+  conf = rng.permutation(N) / N  # no ties, the greedy order is unique
+  cls = rng.integers(0, num_classes, N)
+  return np.concatenate([xy, wh, conf[:,None], cls[:,None]], -1).astype(np.float32)
+
+def nms_greedy_ref(box, iou_threshold, conf_threshold, max_num_box, class_aware=False):
+  """(Numpy) Greedy NMS one box by one box, return the kept rows."""
+  box = box[np.argsort(-box[:,4], kind='stable')]
+  remain = box[:,4] > conf_threshold
+  keep = []
+  for i in range(len(box)):
+    if not remain[i]: continue
+    keep.append(i)
+    if len(keep) == max_num_box: break
+    ious = np.asarray(iou(box[i,:4], box[:,:4]))
+    if class_aware:
+      ious = np.where(box[:,5] == box[i,5], ious, 0.0)
+    remain &= ious <= iou_threshold
+  return box[keep]
+
+def nms_tri_ref(box, iou_threshold, conf_threshold):
+  """(Numpy) The former triangular NMS, a box is removed by any higher box (even a removed one)."""
+  box = box[np.argsort(-box[:,4], kind='stable')]
+  ious = np.asarray(iou(box[:,None,:4], box[None,:,:4]))
+  mask = (box[:,4] > conf_threshold) & ~np.tril(ious > iou_threshold, k=-1).any(1)
+  return box[mask]
+
+def nms_matrix_ref(box, conf_threshold, max_num_box, class_aware=False, kernel='gaussian', sigma=2.0):
+  """(Numpy) Matrix NMS decay of SOLOv2, box by box, return the kept rows with the decayed confidence."""
+  box = box[np.argsort(-box[:,4], kind='stable')]
+  N = len(box)
+  ious = np.asarray(iou(box[:,None,:4], box[None,:,:4])).astype(np.float64)
+  if class_aware:
+    ious = ious * (box[:,5][:,None] == box[:,5][None,:])
+  f = (lambda x: np.exp(-sigma * x ** 2)) if kernel == 'gaussian' else (lambda x: 1 - x)
+  # comp[i]: the maximum IOU of box[i] with the higher confidence boxes
+  comp = np.array([ious[:i,i].max(initial=0.0) for i in range(N)])
+  decay = np.array([min([1.0] + [f(ious[i,j]) / f(comp[i]) for i in range(j)]) for j in range(N)])
+  box = box.astype(np.float64)
+  box[:,4] *= decay
+  box = box[box[:,4] > conf_threshold]
+  return box[np.argsort(-box[:,4], kind='stable')][:max_num_box]
+
+@pytest.mark.parametrize('class_aware', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_nms_greedy(seed, class_aware):
+  rng = np.random.default_rng(seed)
+  box = random_box(rng, 200)
+  for iou_threshold, max_num_box in [(0.3, 100), (0.5, 100), (0.5, 10)]:
+    dbox, pnum = nms(jnp.asarray(box), iou_threshold, 0.2, nms_multi=30, max_num_box=max_num_box, class_aware=class_aware)
+    ref = nms_greedy_ref(box, iou_threshold, 0.2, max_num_box, class_aware)
+    assert int(pnum) == len(ref)
+    np.testing.assert_array_equal(np.asarray(dbox)[:int(pnum)], ref)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_nms_greedy_keeps_triangular(seed):
+  """Greedy NMS keeps every box kept by the former triangular NMS, and the same boxes without chains."""
+  rng = np.random.default_rng(seed)
+  box = random_box(rng, 200)
+  dbox, pnum = nms(jnp.asarray(box), 0.5, 0.2, max_num_box=200)
+  dbox = np.asarray(dbox)[:int(pnum)]
+  ref = nms_tri_ref(box, 0.5, 0.2)
+  assert set(map(tuple, ref)) <= set(map(tuple, dbox))
+  # Far apart boxes: no suppression chain, both are the same
+  box[:,:2] = np.stack(np.meshgrid(np.arange(20), np.arange(10)), -1).reshape(-1, 2) * 50
+  dbox, pnum = nms(jnp.asarray(box), 0.5, 0.2, max_num_box=200)
+  np.testing.assert_array_equal(np.asarray(dbox)[:int(pnum)], nms_tri_ref(box, 0.5, 0.2))
+
+@pytest.mark.parametrize('kernel', ['gaussian', 'linear'])
+@pytest.mark.parametrize('class_aware', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_nms_matrix(seed, class_aware, kernel):
+  rng = np.random.default_rng(seed)
+  box = random_box(rng, 120)
+  for max_num_box in [100, 10]:
+    dbox, pnum = nms_matrix(jnp.asarray(box), 0.1, nms_multi=30, max_num_box=max_num_box, class_aware=class_aware, kernel=kernel)
+    ref = nms_matrix_ref(box, 0.1, max_num_box, class_aware, kernel)
+    assert int(pnum) == len(ref)
+    np.testing.assert_allclose(np.asarray(dbox)[:int(pnum)], ref, rtol=1e-4, atol=1e-6)
+
+def test_nms_empty():
+  box = random_box(np.random.default_rng(0), 50)
+  box[:,4] *= 0.1  # all below the confidence threshold
+  _, pnum = nms(jnp.asarray(box), 0.5, 0.2)
+  assert int(pnum) == 0
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : test_utils_ap.py
+@Desc    :
+Compare the vectorized `ap_per_class` with the per-class loop of `compute_ap`,
+and the streaming `APAccumulator` with the exact `ap_per_class`.
+Run: python -m pytest katacv/utils/detection/test_utils_ap.py
+'''
+import numpy as np
+import pytest
+
+from katacv.utils.detection.utils_ap import ap_per_class, compute_ap, APAccumulator
+
+def ap_per_class_ref(tp, conf, pcls, tcls):
+  """(Numpy) The AP of each class one by one, same return as `ap_per_class`."""
+  sort_i = np.argsort(-conf, kind='stable')
+  tp, conf, pcls = tp[sort_i], conf[sort_i], pcls[sort_i]
+  ucls = np.unique(tcls)
+  shape = (len(ucls), tp.shape[1])
+  ap, p, r = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+  for i, cls in enumerate(ucls):
+    idx = pcls == cls
+    n_p, n_t = idx.sum(), (tcls == cls).sum()
+    if n_p == 0: continue
+    tpc = tp[idx].cumsum(0)
+    recall = tpc / n_t
+    precision = tpc / np.arange(1, n_p + 1)[:,None]
+    r[i] = np.interp(-0.1, -conf[idx], recall[:,0])
+    p[i] = np.interp(-0.1, -conf[idx], precision[:,0])
+    for j in range(tp.shape[1]):
+      ap[i,j] = compute_ap(recall[:,j], precision[:,j])
+  f1 = 2 * p * r / (p + r + 1e-5)
+  return p, r, ap, f1, ucls.astype(np.int32)
+
+def random_case(rng, N, num_classes, num_iout=10, conf=None):
+  """
+  Predictions of a detector with `num_iout` iou thresholds, the higher threshold tp is \
+  a subset of the lower one, and each class has at least as many targets as its tp.
+  """
+  if conf is None: conf = rng.uniform(0, 1, N)
+  conf = conf.astype(np.float32)
+  pcls = rng.integers(0, num_classes, N)
+  u = rng.uniform(size=N) * (1.5 - conf)  # the higher confidence is more likely to be tp
+  tp = u[:,None] < np.linspace(0.8, 0.1, num_iout)
+  n_tp = np.bincount(pcls[tp[:,0]], minlength=num_classes)
+  n_t = n_tp + rng.integers(0, 5, num_classes)
+  n_t[-1] = 0  # one class without target (its predictions are not counted)
+  tcls = np.repeat(np.arange(num_classes), n_t)
+  return tp, conf, pcls.astype(np.float32), tcls
+
+@pytest.mark.parametrize('seed', range(20))
+def test_ap_per_class(seed):
+  rng = np.random.default_rng(seed)
+  N, C = int(rng.integers(1, 500)), int(rng.integers(2, 10))
+  conf = np.round(rng.uniform(0, 1, N), 2) if seed % 2 else None  # with confidence ties
+  case = random_case(rng, N, C, conf=conf)
+  for x, y in zip(ap_per_class(*case), ap_per_class_ref(*case)):
+    np.testing.assert_allclose(x, y, rtol=1e-10, atol=1e-12)
+
+def test_ap_per_class_no_prediction():
+  tcls = np.array([0, 1, 1, 3])
+  p, r, ap, f1, ucls = ap_per_class(np.zeros((0, 10), np.bool_), np.zeros(0), np.zeros(0), tcls)
+  np.testing.assert_array_equal(ucls, [0, 1, 3])
+  assert ap.shape == (3, 10) and not ap.any()
+
+@pytest.mark.parametrize('seed', range(10))
+def test_ap_accumulator_exact(seed):
+  """Each box in its own confidence bin, the binned AP is the exact AP (at the bin lower bound)."""
+  rng = np.random.default_rng(seed)
+  num_bins, N, C = 1000, int(rng.integers(1, 500)), int(rng.integers(2, 10))
+  k = rng.choice(num_bins, N, replace=False)
+  tp, conf, pcls, tcls = random_case(rng, N, C, conf=(k + 0.5) / num_bins)
+  acc = APAccumulator(num_iout=tp.shape[1], num_bins=num_bins)
+  # Stream by batches, the targets are split too
+  for i, t in zip(np.array_split(np.arange(N), 4), np.array_split(rng.permutation(tcls), 4)):
+    acc.update(tp[i], conf[i], pcls[i], t)
+  ref = ap_per_class(tp, k / num_bins, pcls, tcls)
+  for x, y in zip(acc.ap_per_class(), ref):
+    np.testing.assert_allclose(x, y, rtol=1e-10, atol=1e-12)
+
+def test_ap_accumulator_binned():
+  """Continuous confidence, the binned AP is close to the exact AP."""
+  rng = np.random.default_rng(0)
+  tp, conf, pcls, tcls = case = random_case(rng, 20000, 20)
+  acc = APAccumulator(num_iout=tp.shape[1], num_bins=1000)
+  for i in np.array_split(np.arange(len(conf)), 10):
+    acc.update(tp[i], conf[i], pcls[i], tcls[:0])
+  acc.update(tp[:0], conf[:0], pcls[:0], tcls)
+  _, _, ap, _, ucls = acc.ap_per_class()
+  _, _, ref, _, ref_ucls = ap_per_class(*case)
+  np.testing.assert_array_equal(ucls, ref_ucls)
+  np.testing.assert_allclose(ap, ref, atol=5e-3)
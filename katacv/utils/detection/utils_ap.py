@@ -30,28 +30,99 @@ def ap_per_class(tp, conf, pcls, tcls):
     f1: F1 coef for each class with confidence bigger than 0.1. [shape=(Nc,)]
     ucls: Class labels after being uniqued. [shape=(Nc,)]
   """
-  sort_i = np.argsort(-conf)
-  tp, conf, pcls = tp[sort_i], conf[sort_i], pcls[sort_i]
-  ucls = np.unique(tcls)
+  ucls, n_t = np.unique(tcls, return_counts=True)
   shape = (len(ucls), tp.shape[1])
   ap, p, r = np.zeros(shape), np.zeros(shape), np.zeros(shape)
   pr_score = 0.1
-  for i, cls in enumerate(ucls):
-    idx = pcls == cls
-    # number of predict and target boxes with class `cls`
-    n_p, n_t = idx.sum(), (tcls==cls).sum()
-    if n_p == 0: continue
-    fpc = (1-tp[idx]).cumsum(0)  # cumulate false precision
-    tpc = tp[idx].cumsum(0)  # cumulate true precision
-    recall = tpc / n_t
-    r[i] = np.interp(-pr_score, -conf[idx], recall[:,0])  # conf[idx] decrease
-    precision = tpc / (tpc + fpc)
-    p[i] = np.interp(-pr_score, -conf[idx], precision[:,0])
-    for j in range(tp.shape[1]):
-      ap[i,j] = compute_ap(recall[:,j], precision[:,j])
+  idx = np.isin(pcls, ucls)
+  sort_i = np.nonzero(idx)[0]
+  sort_i = sort_i[np.lexsort((-conf[sort_i], pcls[sort_i]))]  # stable sort by class then decrease confidence
+  tp, conf, ci = tp[sort_i].astype(np.int32), conf[sort_i], np.searchsorted(ucls, pcls[sort_i])
+  if len(ci) == 0:
+    return p, r, ap, 2 * p * r / (p + r + 1e-5), ucls.astype(np.int32)
+  # Each class with predicted boxes is one segment
+  n_p = np.bincount(ci, minlength=len(ucls))  # number of predict boxes for each class
+  has = n_p > 0
+  seg = (np.cumsum(has) - 1)[ci]  # segment index of each box
+  end = np.cumsum(n_p[has]) - 1
+  start = end - n_p[has] + 1
+  K, L, S = tp.shape[1], len(ci), len(start)
+  tp = np.ascontiguousarray(tp.T)  # shape=(K,L)
+  tpc = tp.cumsum(1)  # cumulate true positives (segmented)
+  tpc -= np.repeat(np.pad(tpc, ((0,0),(1,0)))[:,start], end - start + 1, axis=1)
+  n = np.arange(L) - start[seg] + 1  # cumulate predict boxes number
+  # conf decrease in each segment
+  r[has] = _segment_interp(np.array([-pr_score]), -conf, tpc[0] / n_t[ci], seg, start, end)
+  p[has] = _segment_interp(np.array([-pr_score]), -conf, tpc[0] / n, seg, start, end)
+  # Only keep the first and the last box with the same recall in each segment, \
+  # the interpolated precision envelope is same as using all the boxes.
+  keep = tp.astype(np.bool_)
+  keep[:,:-1] |= keep[:,1:]
+  keep[:,start] = keep[:,end] = True
+  kk, ii = np.nonzero(keep)  # ordered by (iou threshold, class)
+  recall = tpc[kk,ii] / n_t[ci[ii]]
+  precision = tpc[kk,ii] / n[ii]
+  n = np.bincount(kk * S + seg[ii], minlength=K*S)
+  end = np.cumsum(n) - 1
+  ap[has] = compute_ap_segments(recall, precision, end - n + 1, end).reshape(K, S).T
   f1 = 2 * p * r / (p + r + 1e-5)
   return p, r, ap, f1, ucls.astype(np.int32)
 
+def _segment_interp(x, xp, fp, seg, start, end):
+  """
+  (Numpy) Batched `np.interp(x, xp[start[i]:end[i]+1], fp[start[i]:end[i]+1])` for each segment `i`.
+
+  Args:
+    x: The increasing x-coordinates to evaluate. [shape=(Q,)]
+    xp: Concatenated x-coordinates, nondecreasing in each segment. [shape=(L,)]
+    fp: Concatenated y-coordinates. [shape=(L,)]
+    seg: Segment index of each element, nondecreasing. [shape=(L,)]
+    start, end: The first and the last index of each segment. [shape=(S,)]
+  
+  Return:
+    y: The interpolated values. [shape=(S,Q)]
+  """
+  S, Q = len(start), len(x)
+  xp = xp.astype(np.float64)
+  # cnt[i,q]: number of the xp in segment `i` with xp <= x[q]
+  cnt = np.bincount(seg * (Q+1) + np.searchsorted(x, xp, side='left'), minlength=S*(Q+1))
+  cnt = cnt.reshape(S, Q+1).cumsum(1)[:,:Q]
+  start, end = start[:,None], end[:,None]
+  j = np.maximum(start + cnt - 1, start)  # the last index with xp <= x
+  jn = np.minimum(j + 1, end)
+  xj, fj = xp[j], fp[j]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    y = (fp[jn] - fj) / (xp[jn] - xj) * (x - xj) + fj
+  y = np.where((j == end) | (xj == x), fj, y)
+  return np.where(cnt == 0, fp[start], y)
+
+def compute_ap_segments(recall, precision, start, end):
+  """
+  (Numpy) Batched `compute_ap(recall[start[i]:end[i]+1], precision[start[i]:end[i]+1])` \
+  with 101-point interpolation for each segment `i`.
+
+  Args:
+    recall: Concatenated recall of the segments. [shape=(L,)]
+    precision: Concatenated precision of the segments. [shape=(L,)]
+    start, end: The first and the last index of each segment. [shape=(S,)]
+  
+  Return:
+    ap: The area under the `recall` x `precision` curve. [shape=(S,)]
+  """
+  S = len(start)
+  # Add sentinel values to begin and end of each segment
+  idx = np.concatenate([end+1, start])
+  r = np.insert(recall, idx, np.concatenate([np.minimum(recall[end]+1e-5, 1.0), np.zeros(S)]))
+  p = np.insert(precision, idx, 0.0)
+  n = end - start + 3
+  end = np.cumsum(n) - 1
+  start = end - n + 1
+  seg = np.repeat(np.arange(S), n)
+  # Compute the precision envelope in each segment (offset by segment index, p in [0,1])
+  p = np.flip(np.maximum.accumulate(np.flip(p - 2 * seg))) + 2 * seg
+  x = np.linspace(0, 1, 101)
+  return np.trapz(_segment_interp(x, r, p, seg, start, end), x, axis=-1)
+
 def compute_ap(recall, precision, mode='interp'):
   """
   Compute the average precision (AP) by the area under the curve (AUC) \
@@ -89,3 +160,74 @@ def compute_ap(recall, precision, mode='interp'):
   # plt.title(f"AP={ap:.5f}")
   # plt.show()
   return ap
+
+class APAccumulator:
+  """
+  Streaming accumulator for `ap_per_class`, fold each batch into \
+  per-class confidence-binned TP and predicted box counters, \
+  so the memory is constant in the dataset size and the AP is computed \
+  from the fixed-size histograms (the confidence is rounded down to its bin).
+
+  Args:
+    num_iout: The number of the iou thresholds, same as `tp.shape[1]`.
+    num_bins: The number of the confidence bins in [0,1].
+  """
+  def __init__(self, num_iout: int, num_bins: int = 1000):
+    self.num_iout = num_iout
+    self.num_bins = num_bins
+    self.reset()
+  
+  def reset(self):
+    self.count = np.zeros((0, self.num_bins), np.int64)  # predicted boxes number, [shape=(Nc,num_bins)]
+    self.tp = np.zeros((0, self.num_bins, self.num_iout), np.int64)  # [shape=(Nc,num_bins,num_iout)]
+    self.num_target = np.zeros(0, np.int64)  # [shape=(Nc,)]
+  
+  def _check_num_classes(self, n):
+    if n <= self.num_target.shape[0]: return
+    pad = n - self.num_target.shape[0]
+    self.count = np.pad(self.count, ((0, pad), (0, 0)))
+    self.tp = np.pad(self.tp, ((0, pad), (0, 0), (0, 0)))
+    self.num_target = np.pad(self.num_target, (0, pad))
+  
+  def update(self, tp, conf, pcls, tcls):
+    """
+    Args: (same as `ap_per_class`)
+      tp: True positive of the predicted bounding boxes. [shape=(N,num_iout)]
+      conf: Confidence of the predicted bounding boxes. [shape=(N,)]
+      pcls: Class label of the predicted bounding boxes. [shape=(N,)]
+      tcls: Class label of the target bounding boxes. [shape=(M,)]
+    """
+    pcls, tcls = pcls.astype(np.int64), tcls.astype(np.int64)
+    nc = max(pcls.max(initial=-1), tcls.max(initial=-1)) + 1
+    self._check_num_classes(nc)
+    nc = self.num_target.shape[0]
+    self.num_target += np.bincount(tcls, minlength=nc)
+    bins = np.clip((conf * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+    idx = pcls * self.num_bins + bins
+    size = nc * self.num_bins
+    self.count += np.bincount(idx, minlength=size).reshape(nc, self.num_bins)
+    for j in range(self.num_iout):
+      self.tp[...,j] += np.bincount(idx, weights=tp[:,j], minlength=size).reshape(nc, self.num_bins).astype(np.int64)
+  
+  def ap_per_class(self):
+    """
+    Return: Same as `ap_per_class` (with the binned confidence).
+    """
+    ucls = np.nonzero(self.num_target)[0]
+    shape = (len(ucls), self.num_iout)
+    ap, p, r = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    pr_score = 0.1
+    conf = np.arange(self.num_bins)[::-1] / self.num_bins  # lower bound of each bin, decrease
+    for i, cls in enumerate(ucls):
+      idx = self.count[cls, ::-1] > 0
+      if not idx.any(): continue
+      npc = self.count[cls, ::-1].cumsum(0)[idx]  # cumulate predicted boxes
+      tpc = self.tp[cls, ::-1].cumsum(0)[idx]  # cumulate true positives
+      recall = tpc / self.num_target[cls]
+      r[i] = np.interp(-pr_score, -conf[idx], recall[:,0])
+      precision = tpc / npc[:,None]
+      p[i] = np.interp(-pr_score, -conf[idx], precision[:,0])
+      for j in range(self.num_iout):
+        ap[i,j] = compute_ap(recall[:,j], precision[:,j])
+    f1 = 2 * p * r / (p + r + 1e-5)
+    return p, r, ap, f1, ucls.astype(np.int32)
@@ -0,0 +1,60 @@
+from collections import deque
+import itertools
+import numpy as np
+import jax, jax.numpy as jnp
+
+@jax.jit
+def normalize_image(x):
+  """(JAX) Normalize uint8 image to float32 in [0,1] on device."""
+  return x.astype(jnp.float32) / 255.0
+
+def to_numpy(x):
+  """Convert torch / tf tensor to numpy without copy (CPU tensor)."""
+  if hasattr(x, 'detach'):  # torch.Tensor
+    return x.detach().numpy()
+  return np.asarray(x)
+
+class DevicePrefetcher:
+  """
+  Wrap the batch iterable (torch DataLoader, tf.data.Dataset or any iterable of arrays), \
+  `jax.device_put` the next `size` batches while the current batch is used, \
+  so the host to device copy overlaps with the jitted step.
+
+  It is a drop-in for the training loops:
+  ```
+  for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size):
+    state, metrics = model_step(state, x, y)
+  ```
+
+  Args:
+    ds: The batch iterable, each batch is a pytree of tensors (tuple, list or dict).
+    size: The number of batches on device ahead, `2` is double buffer.
+    transform: The function applied on the device batch (unpacked if the batch is tuple), \
+      e.g. `lambda x, y: (normalize_image(x), y)`.
+    device: The `jax.Device` or `Sharding` to put, `None` is the default device.
+  """
+  def __init__(self, ds, size: int = 2, transform=None, device=None):
+    self.ds, self.size, self.transform, self.device = ds, size, transform, device
+
+  def __len__(self):
+    return len(self.ds)
+
+  def _put(self, batch):
+    batch = jax.tree_util.tree_map(to_numpy, batch, is_leaf=lambda x: not isinstance(x, (tuple, list, dict)))
+    batch = jax.device_put(batch, self.device)  # async
+    if self.transform is not None:
+      batch = self.transform(*batch) if isinstance(batch, (tuple, list)) else self.transform(batch)
+    return batch
+
+  def __iter__(self):
+    queue, iterator = deque(), iter(self.ds)
+    def enqueue(n):
+      for batch in itertools.islice(iterator, n):
+        queue.append(self._put(batch))
+    enqueue(self.size)
+    while queue:
+      # The copy finished long ago in general, waiting for it makes sure the host buffer \
+      # (e.g. a reused `SharedMemoryLoader` slot) is not read after the batch is yielded
+      batch = jax.block_until_ready(queue.popleft())
+      enqueue(1)
+      yield batch
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : image_decoder.py
+@Desc    :
+Decode the images for the dataset loaders, if the target size is at most half of the image,
+JPEG is decoded at reduced resolution in DCT domain (1/2, 1/4, 1/8), which is much
+faster than full decoding and then resizing.
+
+Backends:
+  - `pil`: `PIL.Image.draft`.
+  - `cv2`: `cv2.IMREAD_REDUCED_COLOR_{2,4,8}`.
+
+Benchmark:
+  python katacv/utils/image_decoder.py --path-images /path/to/coco/val2017 --max-size 320
+'''
+from pathlib import Path
+from PIL import Image
+import numpy as np
+import cv2, math
+
+BACKENDS = ['pil', 'cv2']
+_CV2_REDUCED = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def reduce_factor(shape0, max_size):
+  """The maximum DCT reduce factor in (1,2,4,8) which keeps the long side of `shape0` not less than `max_size`."""
+  if max_size is None: return 1
+  factor = 1
+  while factor < 8 and max(shape0) / (factor * 2) >= max_size:
+    factor *= 2
+  return factor
+
+def decode_image(path, max_size: int = None, backend='pil'):
+  """
+  Decode the image as RGB, if `max_size` is given and the long side of the image \
+  is at least `2*max_size`, decode it at reduced resolution (the long side is still \
+  not less than `max_size`), else decode at full resolution.
+
+  Args:
+    path: The image path.
+    max_size: The long side size will be resized to after decoding.
+    backend: `pil` or `cv2`.
+  Return:
+    img: The decoded image. [dtype=uint8, shape=(h,w,3)]
+    shape0: The origin shape `(h0,w0)` of the image.
+  """
+  path = str(path)
+  if backend == 'pil':
+    img = Image.open(path)
+    w0, h0 = img.size
+    factor = reduce_factor((h0, w0), max_size)
+    if factor > 1 and img.format == 'JPEG':
+      img.draft('RGB', (w0 // factor, h0 // factor))
+    return np.array(img.convert('RGB')), (h0, w0)
+  if backend == 'cv2':
+    factor = 1
+    if max_size is not None:
+      w0, h0 = Image.open(path).size  # only read header
+      factor = reduce_factor((h0, w0), max_size)
+    flag = _CV2_REDUCED[factor] if factor > 1 else cv2.IMREAD_COLOR
+    img = cv2.imread(path, flag | cv2.IMREAD_IGNORE_ORIENTATION)  # same as PIL
+    if img is None:  # cv2 doesn't raise on a missing or broken file
+      if not Path(path).exists():
+        raise FileNotFoundError(f"Image file '{path}' doesn't exist")
+      raise ValueError(f"Can't decode the image file '{path}' by cv2")
+    if factor == 1: h0, w0 = img.shape[:2]
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB), (h0, w0)
+  raise ValueError(f"Unknown image decoder backend '{backend}', support {BACKENDS}")
+
+def resize_shape(shape0, max_size: int):
+  """The shape `(h,w)` after resizing the long side of `shape0` to `max_size`."""
+  h0, w0 = shape0
+  r = max_size / max(h0, w0)
+  if r == 1: return h0, w0
+  # clip the float error of ceil, e.g. `math.ceil(281 * (640 / 281)) = 641`
+  return min(math.ceil(h0 * r), max_size), min(math.ceil(w0 * r), max_size)
+
+def decode_resize_image(path, max_size: int, backend='pil'):
+  """
+  Decode the image and resize the long side to `max_size`.
+
+  Return:
+    img: The resized image. [dtype=uint8, shape=(h,w,3)]
+    shape0: The origin shape `(h0,w0)` of the image.
+  """
+  img, shape0 = decode_image(path, max_size, backend)
+  shape = resize_shape(shape0, max_size)
+  if shape != img.shape[:2]:
+    interp = cv2.INTER_LINEAR if shape[0] > img.shape[0] else cv2.INTER_AREA  # enlarge or shrink
+    img = cv2.resize(img, shape[::-1], interpolation=interp)
+  return img, shape0
+
+if __name__ == '__main__':
+  import argparse, time
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path-images", type=Path, required=True)
+  parser.add_argument("--max-size", type=int, default=320)
+  parser.add_argument("--num-images", type=int, default=500)
+  args = parser.parse_args()
+  paths = sorted(p for p in args.path_images.iterdir() if p.suffix.lower() in ['.jpg', '.jpeg'])[:args.num_images]
+  for backend in BACKENDS:
+    for name, max_size in [('full', None), ('reduced', args.max_size)]:
+      start_time = time.time()
+      for p in paths:
+        img, (h0, w0) = decode_image(p, max_size, backend)
+        r = args.max_size / max(h0, w0)
+        cv2.resize(img, (round(w0 * r), round(h0 * r)), interpolation=cv2.INTER_AREA)
+      dt = (time.time() - start_time) / len(paths)
+      print(f"{backend:>4} {name:>7} decode+resize: {dt * 1e3:.2f}ms/img, {1 / dt:.1f}img/s")
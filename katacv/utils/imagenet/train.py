@@ -12,6 +12,7 @@ from katacv.utils.related_pkgs.utility import *
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *  # jax, jnp, flax, nn, train_state, optax
 
 from katacv.utils.logs import Logs, MeanMetric
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 logs = Logs(
   init_logs={
@@ -174,9 +175,9 @@ def train(
       print(f"epoch: {epoch}/{args.total_epochs}")
       print("training...")
       logs.reset()
-      for x, y in tqdm(train_ds, total=train_ds_size):
+      for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size):
         global_step += 1
-        state, *metrics = model_step(state, x.numpy(), y.numpy(), train=True)
+        state, *metrics = model_step(state, x, y, train=True)
         logs.update(
           ['loss_train', 'accuracy_top1_train', 'accuracy_top5_train'],
           metrics
@@ -195,8 +196,8 @@ def train(
           logs.reset()
       print("validating...")
       logs.reset()
-      for x, y in tqdm(val_ds, total=val_ds_size):
-        _, *metrics = model_step(state, x.numpy(), y.numpy(), train=False)
+      for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size):
+        _, *metrics = model_step(state, x, y, train=False)
         logs.update(
           ['loss_val', 'accuracy_top1_val', 'accuracy_top5_val', 'epoch', 'learning_rate'],
           [*metrics, epoch, args.learning_rate_fn(state.step)]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : annotation.py
+@Desc    :
+Packed annotation store, all the boxes of one subset are saved in one contiguous array,
+so loading the boxes of an image is an O(1) slice without opening any file.
+
+`{subset}_annotation.npz` in `path_dataset`:
+  - `paths_img`: The relative image paths. [shape=(N,), dtype=str]
+  - `box`: The boxes of all the images, `(x,y)` is the left top (COCO format). \
+    [shape=(M,5), dtype=float32, elem=(x,y,w,h,cls)]
+  - `offsets`: The boxes of the `i`-th image are `box[offsets[i]:offsets[i+1]]`. [shape=(N+1,), dtype=int64]
+  - `shapes0`: The origin image shape `(h,w)`. [shape=(N,2), dtype=int64]
+  - `max_num_box`: The maximum number of boxes in one image.
+
+Useage:
+  Convert the `{subset}_annotation.txt` and bbox txt files (made by `preprocess_raw_coco_dataset.py`):
+  python katacv/utils/yolo/annotation.py --path-dataset /path/to/coco --subsets train val
+'''
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from PIL import Image
+import numpy as np
+import warnings, argparse
+
+def read_image_shapes(path_dataset: Path, paths_img, num_workers=16):
+  """Read the origin image shapes `(h,w)` from the image headers (without decoding)."""
+  def read(path):
+    w, h = Image.open(str(path_dataset.joinpath(path))).size
+    return h, w
+  with ThreadPoolExecutor(num_workers) as pool:
+    shapes0 = list(tqdm(pool.map(read, paths_img), total=len(paths_img), desc="Read image shapes"))
+  return np.array(shapes0, np.int64).reshape(-1, 2)
+
+def save_annotation(path: Path, paths_img, box, offsets, shapes0):
+  """Save the packed annotation, the file is renamed into place after it is written."""
+  path_tmp = path.with_suffix('.tmp.npz')
+  np.savez(
+    path_tmp, paths_img=np.asarray(paths_img, np.str_),
+    box=np.asarray(box, np.float32).reshape(-1, 5), offsets=np.asarray(offsets, np.int64),
+    shapes0=np.asarray(shapes0, np.int64), max_num_box=np.diff(offsets).max(initial=0),
+  )
+  path_tmp.rename(path)
+
+def load_annotation(path: Path):
+  """Load all the arrays of the packed annotation into memory."""
+  with np.load(path) as file:
+    return {k: file[k] for k in file.files}
+
+def pack_annotation(path_dataset: Path, subset: str, num_workers=16):
+  """
+  Pack `{subset}_annotation.txt` and its bbox txt files (each line is `cls x y w h`) \
+  into `{subset}_annotation.npz`.
+  """
+  paths = np.genfromtxt(str(path_dataset.joinpath(f"{subset}_annotation.txt")), dtype=np.str_)
+  paths_img, paths_box = paths[:, 0], paths[:, 1]
+  def read(path):
+    with warnings.catch_warnings():
+      warnings.simplefilter("ignore")
+      box = np.loadtxt(path_dataset.joinpath(path), dtype=np.float32)
+    return np.roll(box.reshape(-1, 5), -1, axis=1)  # (cls,x,y,w,h) -> (x,y,w,h,cls)
+  with ThreadPoolExecutor(num_workers) as pool:
+    box = list(tqdm(pool.map(read, paths_box), total=len(paths_box), desc=f"Read {subset} boxes"))
+  offsets = np.concatenate([[0], np.cumsum([len(b) for b in box])])
+  shapes0 = read_image_shapes(path_dataset, paths_img, num_workers)
+  path = path_dataset.joinpath(f"{subset}_annotation.npz")
+  save_annotation(path, paths_img, np.concatenate(box), offsets, shapes0)
+  print(f"Save {len(paths_img)} images and {offsets[-1]} boxes to {path}")
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path-dataset", type=Path, required=True)
+  parser.add_argument("--subsets", nargs='+', default=['train', 'val'])
+  parser.add_argument("--num-workers", type=int, default=16)
+  args = parser.parse_args()
+  for subset in args.subsets:
+    pack_annotation(args.path_dataset, subset, args.num_workers)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : augment.py
+@Desc    :
+On-device batched augmentation for the YOLO training pipeline, the same as
+`transform_affine`, `transform_hsv` and flip left-right in `YOLODataset.__getitem__`,
+but each sample gets its random parameters inside one jitted function after the
+batch is on device, so the DataLoader workers only decode and mosaic
+(`YOLODataset(device_augment=True)`).
+'''
+from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
+import math
+
+def rgb2hsv(x):
+  """RGB to HSV, all in [0,1]. [shape=(...,3)]"""
+  r, g, b = x[...,0], x[...,1], x[...,2]
+  maxc, minc = x.max(-1), x.min(-1)
+  delta = maxc - minc
+  s = jnp.where(maxc > 0, delta / jnp.where(maxc > 0, maxc, 1), 0)
+  d = jnp.where(delta > 0, delta, 1)
+  h = jnp.where(maxc == r, (g - b) / d, jnp.where(maxc == g, 2 + (b - r) / d, 4 + (r - g) / d))
+  h = jnp.where(delta > 0, (h / 6) % 1.0, 0)
+  return jnp.stack([h, s, maxc], -1)
+
+def hsv2rgb(x):
+  """HSV to RGB, all in [0,1]. [shape=(...,3)]"""
+  h, s, v = x[...,0], x[...,1], x[...,2]
+  i = jnp.floor(h * 6)
+  f = h * 6 - i
+  p, q, t = v * (1 - s), v * (1 - s * f), v * (1 - s * (1 - f))
+  i = i.astype(jnp.int32) % 6
+  r = jnp.select([i == 0, i == 1, i == 2, i == 3, i == 4], [v, q, p, p, t], v)
+  g = jnp.select([i == 0, i == 1, i == 2, i == 3, i == 4], [t, v, v, q, p], p)
+  b = jnp.select([i == 0, i == 1, i == 2, i == 3, i == 4], [p, p, t, v, v], q)
+  return jnp.stack([r, g, b], -1)
+
+def _bilinear(x, u, v, cval):
+  """Sample image `x` at float pixel positions `(u,v)` by bilinear interpolation, out of image is `cval`."""
+  H, W = x.shape[:2]
+  u0, v0 = jnp.floor(u), jnp.floor(v)
+  fu, fv = (u - u0)[...,None], (v - v0)[...,None]
+  u0, v0 = u0.astype(jnp.int32), v0.astype(jnp.int32)
+  def get(vi, ui):  # gather all the channels at once
+    inside = ((ui >= 0) & (ui < W) & (vi >= 0) & (vi < H))[...,None]
+    return jnp.where(inside, x[jnp.clip(vi, 0, H-1), jnp.clip(ui, 0, W-1)].astype(jnp.float32), cval)
+  return (
+    (get(v0, u0) * (1 - fu) + get(v0, u0 + 1) * fu) * (1 - fv)
+    + (get(v0 + 1, u0) * (1 - fu) + get(v0 + 1, u0 + 1) * fu) * fv
+  )
+
+def _affine_matrix(key, shape, rot, scale, shear, translate, border):
+  """The same random affine matrix as `get_affine_matrix` in `katacv/utils/yolo/utils.py`."""
+  h, w = shape[0] - border * 2, shape[1] - border * 2
+  k = jax.random.split(key, 6)
+  C = jnp.array([[1, 0, -shape[1] / 2], [0, 1, -shape[0] / 2], [0, 0, 1]])
+  theta = jax.random.uniform(k[0], minval=-rot, maxval=rot) * math.pi / 180
+  s = jax.random.uniform(k[1], minval=1 - scale, maxval=1 + scale)
+  R = jnp.array([
+    [s * jnp.cos(theta), s * jnp.sin(theta), 0],
+    [-s * jnp.sin(theta), s * jnp.cos(theta), 0],
+    [0, 0, 1]
+  ])
+  shx, shy = jnp.tan(jax.random.uniform(k[2], (2,), minval=-shear, maxval=shear) * math.pi / 180)
+  S = jnp.array([[1, shx, 0], [shy, 1, 0], [0, 0, 1]])
+  tx = jax.random.uniform(k[3], minval=0.5 - translate, maxval=0.5 + translate) * w
+  ty = jax.random.uniform(k[4], minval=0.5 - translate, maxval=0.5 + translate) * h
+  T = jnp.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+  return T @ S @ R @ C, s
+
+def _augment_one(key, x, box, num, hsv, fliplr, rot, scale, shear, translate, border):
+  H, W = x.shape[0] - 2 * border, x.shape[1] - 2 * border
+  k_affine, k_hsv, k_flip = jax.random.split(key, 3)
+  ### Affine: inverse map each output pixel to the input image, bilinear interpolation ###
+  M, s = _affine_matrix(k_affine, x.shape, rot, scale, shear, translate, border)
+  Minv = jnp.linalg.inv(M)
+  v, u = jnp.meshgrid(jnp.arange(H, dtype=jnp.float32), jnp.arange(W, dtype=jnp.float32), indexing='ij')
+  src = jnp.stack([u, v, jnp.ones_like(u)], -1) @ Minv.T  # shape=(H,W,3)
+  x = _bilinear(x, src[...,0], src[...,1], cval=114.0) / 255.0
+  ### Boxes: transform the 4 corners, clip and filter the small boxes (`box_filter_idxs`) ###
+  xyxy = jnp.concatenate([box[:,:2] - box[:,2:4] / 2, box[:,:2] + box[:,2:4] / 2], -1)
+  corners = xyxy[:, [0,1,2,3,0,3,2,1]].reshape(-1, 4, 2)
+  corners = jnp.concatenate([corners, jnp.ones_like(corners[...,:1])], -1) @ M[:2].T  # shape=(M,4,2)
+  new = jnp.concatenate([corners.min(1), corners.max(1)], -1)
+  new = jnp.clip(new, 0, jnp.array([W, H, W, H]))
+  w1, h1 = box[:,2] * s, box[:,3] * s
+  w2, h2 = new[:,2] - new[:,0], new[:,3] - new[:,1]
+  ar = jnp.maximum(w2 / (h2 + 1e-6), h2 / (w2 + 1e-6))
+  area = w2 * h2 / (w1 * h1 + 1e-6)
+  valid = (w2 > 2) & (h2 > 2) & (area > 0.1) & (ar < 100) & (jnp.arange(box.shape[0]) < num)
+  box = jnp.concatenate([(new[:,:2] + new[:,2:]) / 2, new[:,2:] - new[:,:2], box[:,4:5]], -1)
+  ### HSV ###
+  r = jax.random.uniform(k_hsv, (3,), minval=-1, maxval=1) * jnp.array(hsv) + 1
+  x = rgb2hsv(x)
+  x = jnp.stack([(x[...,0] * r[0]) % 1.0, jnp.clip(x[...,1] * r[1], 0, 1), jnp.clip(x[...,2] * r[2], 0, 1)], -1)
+  x = hsv2rgb(x)
+  ### Flip left-right ###
+  flip = jax.random.uniform(k_flip) < fliplr
+  x = jnp.where(flip, x[:,::-1], x)
+  box = box.at[:,0].set(jnp.where(flip, W - box[:,0], box[:,0]))
+  ### Move the valid boxes to the front ###
+  order = jnp.argsort(~valid)  # stable sort
+  box = jnp.where(valid[order,None], box[order], 0)
+  return x, box, valid.sum()
+
+@partial(jax.jit, static_argnames=['hsv', 'fliplr', 'rot', 'scale', 'shear', 'translate', 'border'])
+def augment_batch(
+    key: jax.Array, x: jax.Array, tbox: jax.Array, tnum: jax.Array,
+    hsv=(0.015, 0.7, 0.4), fliplr=0.5,
+    rot=0.0, scale=0.5, shear=0.0, translate=0.1, border=None
+  ):
+  """
+  (JAX) Random affine, HSV and flip left-right for each sample in the batch.
+
+  Args:
+    key: The random key.
+    x: The images (mosaic without affine). [shape=(N,H,W,3), dtype=uint8]
+    tbox: The padded target boxes in pixel. [shape=(N,M,5), elem=(x,y,w,h,cls)]
+    tnum: The number of target boxes in each image. [shape=(N,)]
+    hsv: The gains of HSV, same as `transform_hsv`.
+    fliplr: The probability of flip left-right.
+    rot, scale, shear, translate: Same as `transform_affine`.
+    border: The border cropped by affine, `None` is `H//4` (the mosaic of `H//2` image).
+  Return:
+    x: The augmented images normalized to [0,1]. [shape=(N,H-2*border,W-2*border,3), dtype=float32]
+    tbox: The transformed boxes, the valid boxes are in front. [shape=(N,M,5)]
+    tnum: The number of valid boxes. [shape=(N,)]
+  """
+  if border is None: border = x.shape[1] // 4
+  keys = jax.random.split(key, x.shape[0])
+  return jax.vmap(
+    partial(
+      _augment_one, hsv=hsv, fliplr=fliplr, rot=rot, scale=scale,
+      shear=shear, translate=translate, border=border
+    )
+  )(keys, x, jnp.asarray(tbox, jnp.float32), tnum)
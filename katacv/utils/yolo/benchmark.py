@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : benchmark.py
+@Desc    :
+Offline throughput benchmark of the YOLO data loader (`katacv/utils/yolo/build_dataset.py`)
+on a synthetic COCO-layout dataset, so the loader regressions can be checked without
+the real dataset.
+
+The synthetic dataset in `path_dataset` (same layout as `preprocess_raw_coco_dataset.py`):
+  - `images/{i}.jpg`: Random smooth JPEG, the shape `(h,w)` is uniform in `[min_size, max_size]`.
+  - `labels/{i}.txt`: Each line is `cls x y w h` (COCO format in pixel), \
+    the number of boxes is Poisson with mean `mean_num_box` (clipped by `max_num_box`).
+  - `{subset}_annotation.txt`: Each line is `images/{i}.jpg labels/{i}.txt`.
+
+Results (written to `--path-output` as JSON):
+  - `stages`: Per-stage time (ms/img) of decode, resize, mosaic4, affine, hsv, padding and collate.
+  - `loader`: The DataLoader throughput (img/s) for each `(cache, num_workers)`.
+
+Useage:
+  python katacv/utils/yolo/benchmark.py --path-dataset /tmp/yolo_synthetic --num-workers 0 4 8 \
+    --caches none ram mmap --path-output logs/loader_benchmark.json
+'''
+from pathlib import Path
+from PIL import Image
+from tqdm import tqdm
+from torch.utils.data import DataLoader, default_collate
+import numpy as np
+import cv2, os, time, json, random, platform, subprocess, argparse
+
+from katacv.utils.yolo.build_dataset import YOLODataset, BucketCollate
+from katacv.utils.yolo.utils import transform_affine, transform_hsv
+from katacv.utils.image_decoder import decode_image, resize_shape
+
+def make_synthetic_dataset(
+    path_dataset: Path, num_images=256, min_size=240, max_size=640,
+    mean_num_box=7.0, max_num_box=50, num_classes=80, subsets=('train', 'val'), seed=0
+  ):
+  """
+  Generate the synthetic dataset (skipped if `{subset}_annotation.txt` exists), \
+  all the subsets share the same images.
+  """
+  if all(path_dataset.joinpath(f"{subset}_annotation.txt").exists() for subset in subsets):
+    return
+  rng = np.random.default_rng(seed)
+  path_dataset.joinpath("images").mkdir(parents=True, exist_ok=True)
+  path_dataset.joinpath("labels").mkdir(parents=True, exist_ok=True)
+  lines = []
+  for i in tqdm(range(num_images), desc="Make synthetic dataset"):
+    h, w = rng.integers(min_size, max_size + 1, 2)
+    # Upsampled noise, closer to the natural image (JPEG size and decode time) than white noise
+    img = rng.integers(0, 256, (h // 16 + 1, w // 16 + 1, 3), dtype=np.uint8)
+    img = cv2.resize(img, (int(w), int(h)), interpolation=cv2.INTER_CUBIC)
+    Image.fromarray(img).save(path_dataset.joinpath(f"images/{i}.jpg"), quality=90)
+    n = min(rng.poisson(mean_num_box), max_num_box)
+    bw, bh = rng.uniform(4, w / 2, n), rng.uniform(4, h / 2, n)
+    x, y = rng.uniform(0, w - bw), rng.uniform(0, h - bh)
+    cls = rng.integers(0, num_classes, n)
+    with path_dataset.joinpath(f"labels/{i}.txt").open('w') as file:
+      file.writelines(f"{c} {x:.2f} {y:.2f} {w:.2f} {h:.2f}\n" for c, x, y, w, h in zip(cls, x, y, bw, bh))
+    lines.append(f"images/{i}.jpg labels/{i}.txt\n")
+  for subset in subsets:
+    path_dataset.joinpath(f"{subset}_annotation.txt").write_text(''.join(lines))
+
+def _timeit(fn, n):
+  """Call `fn(i)` for `i` in `range(n)`, return the average time in ms."""
+  start_time = time.perf_counter()
+  for i in range(n):
+    fn(i)
+  return (time.perf_counter() - start_time) / n * 1e3
+
+def benchmark_stages(ds: YOLODataset, num_samples=64, batch_size=16, decoder='pil'):
+  """
+  The average time (ms/img) of each stage in `YOLODataset.__getitem__` (in the main process). \
+  The collate stages are ms/batch.
+  """
+  n = min(num_samples, len(ds))
+  s = ds.img_size
+  stages = {}
+  paths = [ds.path_dataset.joinpath(p) for p in ds.paths_img[:n]]
+  decoded = [decode_image(p, backend=decoder)[0] for p in paths]
+  stages['decode'] = _timeit(lambda i: decode_image(paths[i], backend=decoder), n)
+  stages['decode_reduced'] = _timeit(lambda i: decode_image(paths[i], s, backend=decoder), n)
+  def resize(i):
+    img = decoded[i]
+    cv2.resize(img, resize_shape(img.shape[:2], s)[::-1], interpolation=cv2.INTER_AREA)
+  stages['resize'] = _timeit(resize, n)
+  mosaics = [ds.mosaic4(i, affine=False) for i in range(n)]
+  stages['mosaic4'] = _timeit(lambda i: ds.mosaic4(i, affine=False), n)
+  stages['mosaic4_affine'] = _timeit(lambda i: ds.mosaic4(i), n)  # fused warp
+  stages['affine'] = _timeit(lambda i: transform_affine(*mosaics[i], border=s // 2), n)
+  imgs = [ds.mosaic4(i)[0] for i in range(n)]
+  stages['hsv'] = _timeit(lambda i: transform_hsv(imgs[i]), n)
+  def padding(i):
+    box = mosaics[i][1]
+    pbox = np.zeros((ds.max_num_box, 5))
+    pbox[:len(box)] = box
+  stages['padding'] = _timeit(padding, n)
+  ### Collate ###
+  pad_box = ds.pad_box
+  ds.pad_box = True
+  padded = [ds[i] for i in range(batch_size)]
+  ds.pad_box = False
+  unpadded = [ds[i] for i in range(batch_size)]
+  ds.pad_box = pad_box
+  collate = BucketCollate(ds.max_num_box)
+  stages['collate'] = _timeit(lambda i: default_collate(padded), 20)
+  stages['collate_bucket'] = _timeit(lambda i: collate(unpadded), 20)
+  return stages
+
+def benchmark_loader(ds: YOLODataset, num_workers: int, batch_size=16, num_batches=50, warmup=2):
+  """The DataLoader throughput (img/s), the first `warmup` batches (workers startup) are not counted."""
+  ds_loader = DataLoader(ds, batch_size=batch_size, shuffle=True, num_workers=num_workers, drop_last=True)
+  num_batches = min(num_batches, len(ds_loader))
+  warmup = min(warmup, num_batches - 1)
+  iterator = iter(ds_loader)
+  for _ in range(warmup):
+    next(iterator)
+  start_time = time.perf_counter()
+  for _ in range(num_batches - warmup):
+    next(iterator)
+  dt = time.perf_counter() - start_time
+  del iterator
+  return (num_batches - warmup) * batch_size / dt
+
+def get_dataset(args, subset, cache):
+  ds = YOLODataset(
+    args.image_size, subset, args.path_dataset, decoder=args.decoder,
+    reservoir_Mb=args.reservoir_Mb if subset == 'train' else 0
+  )
+  if cache == 'ram':
+    ds.build_cache(memory_size_Gb=args.memory_size_Gb)
+    ds.use_cache = True
+  elif cache == 'mmap':
+    ds.build_mmap_cache()
+  return ds
+
+def get_git_commit():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, stderr=subprocess.DEVNULL
+    ).decode().strip()
+  except (subprocess.CalledProcessError, OSError):
+    return None
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path-dataset", type=Path, default=Path("/tmp/yolo_synthetic"),
+    help="the path of the synthetic dataset (made if not exists)")
+  parser.add_argument("--path-output", type=Path, default=None,
+    help="the JSON results path, default is `path_dataset/benchmark_{commit}.json`")
+  parser.add_argument("--num-images", type=int, default=256)
+  parser.add_argument("--min-size", type=int, default=240)
+  parser.add_argument("--max-size", type=int, default=640)
+  parser.add_argument("--mean-num-box", type=float, default=7.0)
+  parser.add_argument("--max-num-box", type=int, default=50)
+  parser.add_argument("--image-size", type=int, default=640)
+  parser.add_argument("--batch-size", type=int, default=16)
+  parser.add_argument("--num-batches", type=int, default=30)
+  parser.add_argument("--num-samples", type=int, default=64,
+    help="the number of samples to time each stage")
+  parser.add_argument("--num-workers", type=int, nargs='+', default=[0, 4, 8])
+  parser.add_argument("--caches", nargs='+', default=['none', 'ram', 'mmap'], choices=['none', 'ram', 'mmap'])
+  parser.add_argument("--subsets", nargs='+', default=['train', 'val'])
+  parser.add_argument("--decoder", default='pil', choices=['pil', 'cv2'])
+  parser.add_argument("--memory-size-Gb", type=float, default=4)
+  parser.add_argument("--reservoir-Mb", type=int, default=0,
+    help="the mosaic reservoir size (Mb) of the train dataset in each worker")
+  parser.add_argument("--seed", type=int, default=0)
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parse_args()
+  random.seed(args.seed); np.random.seed(args.seed)
+  make_synthetic_dataset(
+    args.path_dataset, args.num_images, args.min_size, args.max_size,
+    args.mean_num_box, args.max_num_box, seed=args.seed
+  )
+  results = {
+    'commit': get_git_commit(),
+    'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+    'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+    'config': {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+    'stages': {}, 'loader': {},
+  }
+  ds = get_dataset(args, 'train', 'none')
+  results['stages'] = benchmark_stages(ds, args.num_samples, args.batch_size, args.decoder)
+  for name, dt in results['stages'].items():
+    unit = 'ms/batch' if name.startswith('collate') else 'ms/img'
+    print(f"{name:>15}: {dt:.3f}{unit}")
+  for subset in args.subsets:
+    results['loader'][subset] = {}
+    for cache in args.caches:
+      ds = get_dataset(args, subset, cache)
+      for num_workers in args.num_workers:
+        speed = benchmark_loader(ds, num_workers, args.batch_size, args.num_batches)
+        results['loader'][subset][f"{cache}/{num_workers}"] = speed
+        print(f"{subset:>5} cache={cache:>4} workers={num_workers:>2}: {speed:.1f}img/s")
+  path_output = args.path_output
+  if path_output is None:
+    path_output = args.path_dataset.joinpath(f"benchmark_{results['commit'] or 'unknown'}.json")
+  path_output.parent.mkdir(parents=True, exist_ok=True)
+  path_output.write_text(json.dumps(results, indent=2))
+  print(f"Save results to {path_output}")
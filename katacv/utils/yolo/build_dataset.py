@@ -11,6 +11,7 @@ Dataset size: 178 [00:03<00:00, 56.41it/s]
 from katacv.utils.related_pkgs.utility import *
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
 from katacv.yolov5.parser import YOLOv5Args, get_args_and_writer
+import torch
 from torch.utils.data import Dataset, DataLoader, default_collate
 from katacv.utils.coco.constant import MAX_NUM_BBOXES_TRAIN, MAX_NUM_BBOXES_VAL
 import cv2
@@ -18,26 +19,63 @@ import numpy as np
 from PIL import Image
 import warnings
 import random
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 from katacv.utils.yolo.utils import (
   xywh2xyxy, xywh2cxcywh, xyxy2cxcywh,
-  transform_affine, transform_hsv, transform_pad, show_box
+  transform_affine, transform_affine_tiles, transform_hsv, transform_pad, show_box
 )
+from katacv.utils.yolo.annotation import load_annotation, read_image_shapes
+from katacv.utils.image_decoder import decode_resize_image, resize_shape
 
 class YOLODataset(Dataset):
-  def __init__(self, image_size: int, subset: str, path_dataset: Path):
+  def __init__(
+      self, image_size: int, subset: str, path_dataset: Path,
+      device_augment=False, decoder='pil', pad_box=True, reservoir_Mb=0
+    ):
+    """
+    Args:
+      reservoir_Mb: The memory size (Mb, per worker) of the reservoir of the recently \
+        decoded images, the 3 partner tiles of `mosaic4` are drawn from it, so each \
+        train sample only decodes about one image. `0` is disabled (decode 4 images).
+      pad_box: If taggled, the boxes are padded to `max_num_box`, \
+        else return the boxes without padding (float32) for `BucketCollate`.
+      decoder: The backend of `katacv.utils.image_decoder`, `pil` or `cv2`.
+      device_augment: If taggled, the train images are only mosaic (without affine), \
+        shape=`(2*image_size,2*image_size,3)`, the affine, HSV and flip are done by \
+        `katacv.utils.yolo.augment.augment_batch` on device.
+    """
     self.img_size = image_size
+    self.device_augment = device_augment
+    self.decoder = decoder
+    self.pad_box = pad_box
     self.path_dataset = path_dataset
     self.subset = subset
     self.augment = False if subset == 'val' else True
     self.max_num_box = (
       MAX_NUM_BBOXES_TRAIN if subset == 'train' else MAX_NUM_BBOXES_VAL
     ) * 4  # use 4 mosaic
-    path_annotation = self.path_dataset.joinpath(f"{subset}_annotation.txt")
-    paths = np.genfromtxt(str(path_annotation), dtype=np.str_)
-    self.paths_img, self.paths_box = paths[:, 0], paths[:, 1]
+    path_packed = self.path_dataset.joinpath(f"{subset}_annotation.npz")
+    if path_packed.exists():  # packed annotation store (katacv/utils/yolo/annotation.py)
+      annotation = load_annotation(path_packed)
+      self.paths_img, self.paths_box = annotation['paths_img'], None
+      self.box, self.offsets, self.shapes0 = annotation['box'], annotation['offsets'], annotation['shapes0']
+      self.max_num_box = int(annotation['max_num_box']) * 4
+    else:
+      path_annotation = self.path_dataset.joinpath(f"{subset}_annotation.txt")
+      paths = np.genfromtxt(str(path_annotation), dtype=np.str_)
+      self.paths_img, self.paths_box = paths[:, 0], paths[:, 1]
+      self.box = self.offsets = self.shapes0 = None
     self.use_cache = False
     self.cache = []
+    self.rect_order = self.rect_shapes = None  # rectangular batches, see `build_rect`
+    self.mmap_index = None  # (offsets, shapes, shapes0, skip) of the memory-mapped cache
+    self.path_mmap = None
+    self._mmap = None  # opened lazily in each process
+    self.reservoir_bytes = int(reservoir_Mb * 1024 ** 2)
+    self.reservoir = OrderedDict()  # idx -> (img, box, shape), each worker has its own copy
+    self._reservoir_size = 0
   
   def __len__(self):
     return len(self.paths_img)
@@ -48,39 +86,78 @@ class YOLODataset(Dataset):
       bboxes = np.array([[0,0,1,1,-1]], dtype=np.float32)  # placeholder
     return bboxes
   
+  def load_image(self, idx):
+    """
+    Load the image and resize the max aspect to `image_size`.
+
+    Return:
+      img: The resized image. [dtype=uint8, shape=(h,w,3)]
+      shape0: The origin shape `(h0,w0)` of the image.
+    """
+    if self.mmap_index is not None and idx < len(self.mmap_index[1]) and not self.mmap_index[3][idx]:
+      if self._mmap is None:
+        self._mmap = np.memmap(self.path_mmap, dtype=np.uint8, mode='r')
+      offsets, shapes, shapes0, _ = self.mmap_index
+      img = self._mmap[offsets[idx]:offsets[idx+1]].reshape(shapes[idx])  # zero-copy
+      return img, tuple(shapes0[idx])
+    return decode_resize_image(self.path_dataset.joinpath(self.paths_img[idx]), self.img_size, self.decoder)
+
+  def _resize_shape(self, h0, w0):
+    return resize_shape((h0, w0), self.img_size)
+
   def load_file(self, idx):
     if self.use_cache and idx < len(self.cache):
       return self.cache[idx]
-    path_img, path_box = self.paths_img[idx], self.paths_box[idx]
-    img = np.array(Image.open(str(self.path_dataset.joinpath(path_img))).convert('RGB')).astype('uint8')
-    with warnings.catch_warnings():
-      warnings.simplefilter("ignore")
-      box = np.loadtxt(self.path_dataset.joinpath(path_box))
-    if len(box):
-      box = np.roll(box.reshape(-1, 5), -1, axis=1)
+    img, (h0, w0) = self.load_image(idx)
+    if self.box is not None:
+      box = self.box[self.offsets[idx]:self.offsets[idx+1]].astype(np.float64)  # copy, changed in place later
     else:
-      box = box.reshape(0, 5)
-
-    h0, w0 = img.shape[:2]
-    r = self.img_size / max(h0, w0)
-    if r != 1:  # resize the max aspect to image_size
-      interp = cv2.INTER_LINEAR if r > 1 else cv2.INTER_AREA  # enlarge or shrink
-      img = cv2.resize(img, (math.ceil(w0 * r), math.ceil(h0 * r)), interpolation=interp)
-      if len(box):
-        box[:, [0,2]] *= img.shape[1] / w0
-        box[:, [1,3]] *= img.shape[0] / h0
+      with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        box = np.loadtxt(self.path_dataset.joinpath(self.paths_box[idx]))
+      box = np.roll(box.reshape(-1, 5), -1, axis=1)
+    if len(box):
+      box[:, [0,2]] *= img.shape[1] / w0
+      box[:, [1,3]] *= img.shape[0] / h0
     return img, box, img.shape[:2]
 
-  def mosaic4(self, idx):
+  def load_reservoir(self, idx):
+    """
+    Load the file from the reservoir (only decode on a miss) and put it into the reservoir, \
+    the least recently used images are dropped while the reservoir is out of `reservoir_bytes`.
+    """
+    if idx in self.reservoir:
+      self.reservoir.move_to_end(idx)
+      return self.reservoir[idx]
+    data = self.load_file(idx)
+    self.reservoir[idx] = data
+    self._reservoir_size += data[0].nbytes
+    while self._reservoir_size > self.reservoir_bytes and len(self.reservoir) > 1:
+      self._reservoir_size -= self.reservoir.popitem(last=False)[1][0].nbytes
+    return data
+
+  def mosaic4_files(self, idx):
+    """The files of the 4 mosaic tiles, the 3 partners are from the reservoir (if full enough)."""
+    if self.reservoir_bytes == 0:
+      idxs = [idx] + random.choices(range(len(self.paths_img)), k=3)
+      return [self.load_file(i) for i in idxs]
+    partners = list(self.reservoir.keys())
+    files = [self.load_reservoir(idx)]
+    if len(partners) >= 3:
+      files += [self.load_reservoir(i) for i in random.sample(partners, 3)]  # hit, mark as used
+    else:  # warmup
+      files += [self.load_reservoir(i) for i in random.choices(range(len(self.paths_img)), k=3)]
+    return files
+
+  def mosaic4(self, idx, affine=True):
     s = self.img_size
-    idxs = [idx] + random.choices(range(len(self.paths_img)), k=3)
-    random.shuffle(idxs)
+    files = self.mosaic4_files(idx)
+    random.shuffle(files)
     border = s // 2
     cx, cy = np.random.uniform(border, s+border, 2).astype(np.int32)
-    img4, box4 = np.full((2*s, 2*s, 3), 114, dtype=np.uint8), []  # 114 is the img RGB mean averaged in ImageNet
-    for i, idx in enumerate(idxs):
-      img, box, (h, w) = self.load_file(idx)  # box: COCO fmt
-      box = xywh2xyxy(box)
+    tiles, box4 = [], []
+    for i, (img, box, (h, w)) in enumerate(files):  # box: COCO fmt
+      box = xywh2xyxy(box.copy())  # the cached box is shared
       if i == 0:
         bx2, by2, bx1, by1 = cx, cy, max(0, cx-w), max(0, cy-h)
         sx2, sy2, sx1, sy1 = w, h, w - (bx2-bx1) , h - (by2 - by1)
@@ -93,17 +170,25 @@ class YOLODataset(Dataset):
       else:
         bx1, by1, bx2, by2 = cx, cy, min(2*s, cx+w), min(2*s, cy+h)
         sx1, sy1, sx2, sy2 = 0, 0, bx2 - bx1, by2 - by1
-      img4[by1:by2, bx1:bx2] = img[sy1:sy2, sx1:sx2]
+      tiles.append((img[sy1:sy2, sx1:sx2], (bx1, by1)))  # place at img4[by1:by2, bx1:bx2]
       dx, dy = bx1 - sx1, by1 - sy1
       box4.append(box + np.array([[dx, dy, dx, dy, 0]]))
     box4 = np.concatenate(box4, axis=0)
     box4[:,:4] = np.clip(box4[:,:4], 0, 2*s)
-    img4, box4 = transform_affine(img4, box4, border=border)
+    if not affine:
+      img4 = np.full((2*s, 2*s, 3), 114, dtype=np.uint8)  # 114 is the img RGB mean averaged in ImageNet
+      for img, (x, y) in tiles:
+        img4[y:y+img.shape[0], x:x+img.shape[1]] = img
+      return img4, xyxy2cxcywh(box4)
+    # Warp each tile into the output directly, the 2s x 2s mosaic (filled by 114) is never built
+    img4, box4 = transform_affine_tiles(tiles, (2*s, 2*s, 3), box4, border=border)
     box4 = xyxy2cxcywh(box4)
     return img4, box4
 
   def __getitem__(self, idx):
-    if self.augment:
+    if self.augment and self.device_augment:
+      img, box = self.mosaic4(idx, affine=False)  # other augmentations on device
+    elif self.augment:
       img, box = self.mosaic4(idx)  # yolo format (R)
       img = transform_hsv(img)
       if random.random() < 0.5:  # Flip left-right
@@ -111,12 +196,18 @@ class YOLODataset(Dataset):
         if len(box):
           box[:, 0] = img.shape[1] - box[:, 0]
     else:
+      shape = (self.img_size, self.img_size)
+      if self.rect_order is not None:
+        shape = self.rect_shapes[idx // self.rect_batch_size]
+        idx = self.rect_order[idx]
       img, box, _ = self.load_file(idx)
-      img, (dh, dw) = transform_pad(img, (self.img_size, self.img_size))
+      img, (dh, dw) = transform_pad(img, shape)
       box[:, 0] += dw
       box[:, 1] += dh
       box = xywh2cxcywh(box)
 
+    if not self.pad_box:
+      return img.copy(), box.astype(np.float32), len(box)
     pbox = np.zeros((self.max_num_box, 5))  # faster than np.pad
     if len(box):
       pbox[:len(box)] = box
@@ -130,21 +221,153 @@ class YOLODataset(Dataset):
     for i in bar:
       self.cache.append(self.load_file(i))
 
+  def build_rect(self, batch_size: int, stride=32, pad=0.5, max_shapes=16):
+    """
+    Rectangular batches (without augmentation): the images are sorted by aspect ratio, \
+    each `batch_size` consecutive images are padded to the same smallest rectangle \
+    with a margin of `pad` stride (multiple of `stride`, same as the YOLOv5 rect batches) \
+    instead of the `image_size` square, so the DataLoader must not shuffle.
+
+    Args:
+      pad: The margin of the batch shape in stride, so the objects on the image border \
+        are not on the last cell.
+      max_shapes: The maximum number of the different batch shapes (each one is compiled), \
+        the short side is rounded up to `max_shapes//2` levels, `None` keeps all the shapes.
+    """
+    shapes0 = self.shapes0
+    if shapes0 is None:
+      shapes0 = read_image_shapes(self.path_dataset, self.paths_img)
+    ar = shapes0[:,0] / shapes0[:,1]  # h/w
+    self.rect_order = np.argsort(ar, kind='stable')
+    ar = ar[self.rect_order]
+    starts = np.arange(0, len(ar), batch_size)
+    mini, maxi = np.minimum.reduceat(ar, starts), np.maximum.reduceat(ar, starts)
+    shapes = np.ones((len(starts), 2))  # (h,w) relative to image_size
+    shapes[maxi < 1, 0] = maxi[maxi < 1]
+    shapes[mini > 1, 1] = 1 / mini[mini > 1]
+    shapes = np.ceil(shapes * self.img_size / stride + pad)  # in stride
+    if max_shapes is not None:  # the long side is the same, quantize the short side
+      full = np.ceil(self.img_size / stride + pad)
+      step = np.ceil(full / max(max_shapes // 2, 1))
+      shapes = np.minimum(np.ceil(shapes / step) * step, full)
+    self.rect_shapes = (shapes * stride).astype(np.int32)
+    self.rect_batch_size = batch_size
+
+  def build_mmap_cache(self, path_cache: Path = None, num_workers=8):
+    """
+    Build (only once) the resized uint8 images into one flat file `{path_cache}.bin` \
+    with the index `{path_cache}.npz` (offsets, shapes, origin shapes, skip mask), \
+    then every process opens it read-only by `np.memmap`, so the cache is \
+    shared by the DataLoader workers and survives restarts. The images whose decoded \
+    shape is not the recorded shape are reported and skipped (decoded in `load_image`).
+
+    Args:
+      path_cache: The cache path without suffix, default is \
+        `path_dataset/cache/{subset}_{image_size}`.
+      num_workers: The number of threads to decode the images.
+    """
+    if path_cache is None:
+      path_cache = self.path_dataset.joinpath(f"cache/{self.subset}_{self.img_size}")
+    path_bin, path_index = path_cache.with_suffix('.bin'), path_cache.with_suffix('.npz')
+    if not path_index.exists():  # the index is written after all the images
+      path_cache.parent.mkdir(parents=True, exist_ok=True)
+      n = len(self)
+      shapes0 = self.shapes0
+      if shapes0 is None:
+        shapes0 = read_image_shapes(self.path_dataset, self.paths_img, num_workers)
+      shapes = np.array([(*self._resize_shape(h0, w0), 3) for h0, w0 in shapes0], np.int64).reshape(n, 3)
+      offsets = np.concatenate([[0], np.cumsum(shapes.prod(1))])
+      print(f"Build {self.subset} memory-mapped cache {offsets[-1] / 1024 ** 3:.1f}Gb to {path_bin}...")
+      mmap = np.memmap(path_bin, dtype=np.uint8, mode='w+', shape=(max(offsets[-1], 1),))
+      def write(i):
+        img, _ = self.load_image(i)
+        if img.shape != tuple(shapes[i]):  # e.g. the header shape is wrong (EXIF), decode it in `load_image`
+          return False
+        mmap[offsets[i]:offsets[i+1]] = img.reshape(-1)
+        return True
+      with ThreadPoolExecutor(num_workers) as pool:
+        skip = ~np.array(list(tqdm(pool.map(write, range(n)), total=n)), np.bool_).reshape(n)
+      mmap.flush(); del mmap
+      if skip.any():
+        warnings.warn(
+          f"Skip {skip.sum()} images in the memory-mapped cache, the decoded shape is not the recorded shape: "
+          + ", ".join(str(p) for p in self.paths_img[skip][:10]) + (" ..." if skip.sum() > 10 else "")
+        )
+      np.savez(path_index.with_suffix('.tmp.npz'), offsets=offsets, shapes=shapes, shapes0=shapes0, skip=skip)
+      path_index.with_suffix('.tmp.npz').rename(path_index)
+    with np.load(path_index) as index:
+      skip = index['skip'] if 'skip' in index.files else np.zeros(len(index['shapes']), np.bool_)
+      self.mmap_index = (index['offsets'], index['shapes'], index['shapes0'], skip)
+    self.path_mmap, self._mmap = path_bin, None
+
+class BucketCollate:
+  """
+  Collate the samples (boxes without padding) and pad the boxes to the smallest bucket \
+  in `min_size * 2**k` (and `max_num_box`) which fits the batch, so there are only \
+  a few different box shapes to compile.
+  """
+  def __init__(self, max_num_box: int, min_size=16):
+    self.buckets = [min(min_size, max_num_box)]
+    while self.buckets[-1] < max_num_box:
+      self.buckets.append(min(self.buckets[-1] * 2, max_num_box))
+
+  def __call__(self, batch):
+    img, box, num = zip(*batch)
+    size = self.buckets[np.searchsorted(self.buckets, max(num))]
+    pbox = np.zeros((len(box), size, 5), np.float32)
+    for i, b in enumerate(box):
+      pbox[i,:len(b)] = b
+    return torch.from_numpy(np.stack(img)), torch.from_numpy(pbox), torch.tensor(num)
+
 class DatasetBuilder:
   args: YOLOv5Args
 
   def __init__(self, args: YOLOv5Args):
     self.args = args
   
-  def get_dataset(self, subset: str = 'val', use_cache=True):
-    dataset = YOLODataset(image_size=self.args.image_shape[0], subset=subset, path_dataset=self.args.path_dataset)
-    ds = DataLoader(
-      dataset, batch_size=self.args.batch_size,
-      shuffle=subset == 'train',
-      num_workers=self.args.num_data_workers,
-      drop_last=True,
+  def get_dataset(
+      self, subset: str = 'val', use_cache=True, cache_type='ram',
+      device_augment=False, rect=False, bucket_box=False, reservoir_Mb=0,
+      shm_transport=False
+    ):
+    """
+    Args:
+      shm_transport: Use `katacv.utils.yolo.shm_loader.SharedMemoryLoader` (persistent workers, \
+        the batches are numpy views of shared memory) instead of the torch DataLoader.
+      reservoir_Mb: The mosaic reservoir size (Mb) in each worker, see `YOLODataset`.
+      bucket_box: Pad the boxes of each batch to power-of-two buckets, see `BucketCollate`.
+      rect: Rectangular batches for validation, see `YOLODataset.build_rect`.
+      device_augment: Only do mosaic in the workers, see `YOLODataset`.
+      cache_type: `ram` loads (part of) the images into a list in memory, \
+        `mmap` builds an on-disk memory-mapped cache shared by all workers.
+    """
+    dataset = YOLODataset(
+      image_size=self.args.image_shape[0], subset=subset,
+      path_dataset=self.args.path_dataset, device_augment=device_augment, pad_box=not bucket_box,
+      reservoir_Mb=reservoir_Mb if subset == 'train' else 0
     )
-    if use_cache:
+    if shm_transport:
+      from katacv.utils.yolo.shm_loader import SharedMemoryLoader
+      ds = SharedMemoryLoader(
+        dataset, batch_size=self.args.batch_size,
+        shuffle=subset == 'train' and not rect,
+        num_workers=self.args.num_data_workers,
+        drop_last=True,
+      )
+    else:
+      ds = DataLoader(
+        dataset, batch_size=self.args.batch_size,
+        shuffle=subset == 'train' and not rect,
+        num_workers=self.args.num_data_workers,
+        drop_last=True,
+        collate_fn=BucketCollate(dataset.max_num_box) if bucket_box else None,
+      )
+    if rect:
+      assert not dataset.augment, "Rectangular batches only support the dataset without augmentation"
+      dataset.build_rect(self.args.batch_size)
+    if use_cache and cache_type == 'mmap':
+      ds.dataset.build_mmap_cache(num_workers=max(self.args.num_data_workers, 1))
+    elif use_cache:
       ds.dataset.build_cache()
       ds.dataset.use_cache = True
     return ds
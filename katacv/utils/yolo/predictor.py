@@ -12,9 +12,11 @@ P@50=0.5012 R@50=0.3885 AP@50=0.3507 AP@75=0.1545 mAP=0.1729: 100%|████|
 '''
 from katacv.utils.related_pkgs.utility import *
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
-from katacv.utils.detection import iou_multiply, nms
-from katacv.utils.detection.utils_ap import ap_per_class
+from katacv.utils.detection import iou_multiply, nms, nms_matrix
+from katacv.utils.detection.utils_ap import ap_per_class, APAccumulator
 import numpy as np
+import os, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 class BasePredictor:
   """
@@ -27,26 +29,32 @@ class BasePredictor:
     tcls: Class of target bounding boxes. List[cls.shape=(M',)]
     tp: Ture positive for the `pbox`. List[tp.shape=(M,len(iout))]
     iout: The threshold of iou for deciding whether is the ture positive. List[int]
+    accumulator: If not `None`, fold `tp`, `conf`, `pcls` and `tcls` of each batch \
+      into it instead of keeping them in the lists, the memory is constant in dataset size.
   """
   pbox: List[np.ndarray]  # np.float32
   tcls: List[np.ndarray]  # np.int32
   tp: List[np.ndarray]  # np.bool_
   iout: jax.Array
+  accumulator: APAccumulator | None
 
-  def __init__(self, state: train_state.TrainState, iout=None, image_shape: Tuple=(640, 640, 3)):
+  def __init__(self, state: train_state.TrainState, iout=None, image_shape: Tuple=(640, 640, 3), accumulator: APAccumulator = None):
     self.state = state
     self.iout = jnp.linspace(0.5, 0.95, 10) if iout is None else iout
     self.image_shape = image_shape
     if type(self.iout) == float:
       self.iout = jnp.array([self.iout,])
+    self.accumulator = accumulator
     self.reset()
   
   def reset(self, state: train_state.TrainState = None):
     self.pbox, self.tcls, self.tp = [], [], []
+    if self.accumulator is not None:
+      self.accumulator.reset()
     if state is not None:
       self.state = state
   
-  def update(self, x, tbox=None, tnum=None, nms_iou=0.65, nms_conf=0.001):
+  def update(self, x, tbox=None, tnum=None, nms_iou=0.65, nms_conf=0.001, class_aware=False, nms_mode='greedy'):
     """
     Update the prediction variables.
 
@@ -58,24 +66,34 @@ class BasePredictor:
       tnum: The number of the target bounding boxes. [shape=(B,) or int]
       nms_iou: The threshold of the iou in NMS.
       nms_conf: The threshold of the confidence in NMS.
+      class_aware: If taggled, NMS is computed for each class independently.
+      nms_mode: `greedy` (exact greedy NMS) or `matrix` (parallel Matrix NMS, `nms_iou` is unused).
     """
     if x.ndim == 3: x = x[None,...]
     if tbox is None and tnum is None:
-      pbox, pnum = jax.device_get(self.pred_and_nms(self.state, x, nms_iou, nms_conf))
+      pbox, pnum = jax.device_get(self.pred_and_nms(self.state, x, nms_iou, nms_conf, class_aware=class_aware, nms_mode=nms_mode))
     else:
       assert(tbox is not None and tnum is not None)
       if tbox.ndim == 2: tbox = tbox[None,...]
       if type(tnum) == int: tnum = jnp.array((tnum,))
       pbox, pnum, tp = jax.device_get(self.pred_and_nms_and_tp(
-        self.state, x, nms_iou, nms_conf, tbox, tnum
+        self.state, x, nms_iou, nms_conf, tbox, tnum, class_aware, nms_mode
       ))
     n = x.shape[0]
-    for i in range(n):
-      self.pbox.append(pbox[i][:pnum[i]])
-      if tbox is not None:
-        self.tcls.append(tbox[i][:tnum[i],4].astype(np.int32))
-        self.tp.append(tp[i][:pnum[i]])
-    return self.pbox[-n:]
+    pbox = [pbox[i][:pnum[i]] for i in range(n)]
+    if self.accumulator is None:
+      self.pbox.extend(pbox)
+    if tbox is not None:
+      tbox, tnum = np.asarray(tbox), np.asarray(tnum)  # maybe on device
+      tcls = [tbox[i][:tnum[i],4].astype(np.int32) for i in range(n)]
+      tp = [tp[i][:pnum[i]] for i in range(n)]
+      if self.accumulator is not None:
+        box = np.concatenate(pbox, axis=0)
+        self.accumulator.update(np.concatenate(tp, axis=0), box[:,4], box[:,5], np.concatenate(tcls, axis=0))
+      else:
+        self.tcls.extend(tcls)
+        self.tp.extend(tp)
+    return pbox
   
   def ap_per_class(self):
     """
@@ -89,6 +107,8 @@ class BasePredictor:
       f1: F1 coef for each class with confidence bigger than 0.1. [shape=(Nc,)]
       ucls: Class labels after being uniqued. [shape=(Nc,)]
     """
+    if self.accumulator is not None:
+      return self.accumulator.ap_per_class()
     pbox = np.concatenate(self.pbox, axis=0)
     return ap_per_class(
       tp=np.concatenate(self.tp, axis=0),
@@ -125,37 +145,48 @@ class BasePredictor:
     """
     pass
 
-  @partial(jax.jit, static_argnums=[0])
-  def pred_bounding_check(self, pbox):
+  @partial(jax.jit, static_argnums=[0,2])
+  def pred_bounding_check(self, pbox, image_shape=None):
+    """Clip the boxes in the image with `image_shape=(H,W)`, default is `self.image_shape`."""
+    if image_shape is None: image_shape = self.image_shape
     x1 = jnp.maximum(pbox[...,0] - pbox[...,2] / 2, 0)
     y1 = jnp.maximum(pbox[...,1] - pbox[...,3] / 2, 0)
-    x2 = jnp.minimum(pbox[...,0] + pbox[...,2] / 2, self.image_shape[1])
-    y2 = jnp.minimum(pbox[...,1] + pbox[...,3] / 2, self.image_shape[0])
+    x2 = jnp.minimum(pbox[...,0] + pbox[...,2] / 2, image_shape[1])
+    y2 = jnp.minimum(pbox[...,1] + pbox[...,3] / 2, image_shape[0])
     w, h = x2 - x1, y2 - y1
     return jnp.concatenate([jnp.stack([x1+w/2, y1+h/2, w, h], -1), pbox[...,4:]], -1)
 
-  @partial(jax.jit, static_argnums=[0,3,4,5])
+  @partial(jax.jit, static_argnums=[0,3,4,5,6,7])
   def pred_and_nms(
     self, state: train_state.TrainState, x: jax.Array,
-    iou_threshold: float, conf_threshold: float, nms_multi: float = 30
+    iou_threshold: float, conf_threshold: float, nms_multi: float = 30,
+    class_aware: bool = False, nms_mode: str = 'greedy'
   ):
     pbox = self.predict(state, x)
-    pbox = self.pred_bounding_check(pbox)
+    pbox = self.pred_bounding_check(pbox, tuple(x.shape[1:3]))  # maybe rectangular image
     # pbox, pnum = jax.vmap(
     #   nms, in_axes=[0, None, None, None], out_axes=0
     # )(pbox, iou_threshold, conf_threshold, nms_multi)
-    pbox, pnum = jax.vmap(
-      nms, in_axes=[0, None, None, None], out_axes=0
-    )(pbox, iou_threshold, conf_threshold, nms_multi)
+    if nms_mode == 'matrix':  # Matrix NMS doesn't need iou threshold
+      pbox, pnum = jax.vmap(
+        partial(nms_matrix, nms_multi=nms_multi, class_aware=class_aware),
+        in_axes=[0, None], out_axes=0
+      )(pbox, conf_threshold)
+    else:
+      pbox, pnum = jax.vmap(
+        partial(nms, nms_multi=nms_multi, class_aware=class_aware),
+        in_axes=[0, None, None], out_axes=0
+      )(pbox, iou_threshold, conf_threshold)
     return pbox, pnum
   
-  @partial(jax.jit, static_argnums=[0,3,4])
+  @partial(jax.jit, static_argnums=[0,3,4,7,8])
   def pred_and_nms_and_tp(
     self, state: train_state.TrainState, x: jax.Array,
     iou_threshold: float, conf_threshold: float,
-    tbox: jax.Array, tnum: jax.Array
+    tbox: jax.Array, tnum: jax.Array,
+    class_aware: bool = False, nms_mode: str = 'greedy'
   ):
-    pbox, pnum = self.pred_and_nms(state, x, iou_threshold, conf_threshold)
+    pbox, pnum = self.pred_and_nms(state, x, iou_threshold, conf_threshold, class_aware=class_aware, nms_mode=nms_mode)
     pbox, tp = jax.vmap(self.compute_tp, in_axes=[0,0,0,0,None], out_axes=0)(
       pbox, pnum, tbox, tnum, self.iout
     )
@@ -165,7 +196,7 @@ class BasePredictor:
   @jax.jit
   def compute_tp(pbox, pnum, tbox, tnum, iout):
     """
-    Compute the true positive for each `pbox`. Time complex: O(NM)
+    Compute the true positive for each `pbox` by matrix operations. Time complex: O(NM)
 
     Args:
       pbox: The predicted bounding boxes. [shape=(N,6), elem=(x,y,w,h,conf,cls)]
@@ -181,73 +212,110 @@ class BasePredictor:
     """
     sort_i = jnp.argsort(-pbox[:,4])
     pbox = pbox[sort_i]  # Decrease by confidence
-    tp = jnp.zeros((pbox.shape[0],iout.shape[0]), jnp.bool_)
-    def solve(tp):  # If tnum > 0
-      ious = iou_multiply(pbox[:,:4], tbox[:,:4])  # shape=(N,M)
-      bel = jnp.full_like(tp, -1, dtype=jnp.int32)  # calculate belong for each iou threshold
-      # Get tp and belong
-      def loop_i_fn(i, value):  # i=0,...,pnum-1
-        tp, bel = value
-        iou = ious[i]
-        j = jnp.argmax((tbox[:,4]==pbox[i,5]) * iou)  # belong to tbox[j]
-        # Round to 0.01, https://github.com/rafaelpadilla/Object-Detection-Metrics
-        def update(value):
-          tp, bel = value
-          tp = tp.at[i].set((iou[j].round(2) >= iout - 1e-5) & (j < tnum))
-          bel = bel.at[i].set(j)
-          return tp, bel
-        tp, bel = jax.lax.cond(tbox[j,4]==pbox[i,5], update, lambda x: x, (tp, bel))
-        return tp, bel
-      tp, bel = jax.lax.fori_loop(0, pnum, loop_i_fn, (tp, bel))
-      # Remove duplicate belong
-      # bel = jnp.where(tp.sum(1) > 0, bel, -1)  # WRONG: tp.sum(1) means use 50iou to remove other duplicate, but we should consider independently
-      bel = jnp.where(tp, bel, -1)
-      mask = jnp.zeros_like(bel, jnp.bool_)
-      def loop_j_fn(j, mask):  # j=0,...,tnum-1
-        tmp = bel == j
-        tmp = tmp.at[jnp.argmax(tmp,0), jnp.arange(tmp.shape[1])].set(False)  # use argmax to get the first nonzero arg
-        mask = mask | tmp
-        return mask
-      mask = jax.lax.fori_loop(0, tnum, loop_j_fn, mask)
-      tp = tp * (~mask)
-      return tp
-    tp = jax.lax.cond(tnum > 0, solve, lambda x: x, tp)
+    N, M = pbox.shape[0], tbox.shape[0]
+    ious = iou_multiply(pbox[:,:4], tbox[:,:4])  # shape=(N,M)
+    bel = jnp.argmax((tbox[None,:,4]==pbox[:,5:6]) * ious, axis=1)  # pbox[i] belong to tbox[bel[i]]
+    iou = ious[jnp.arange(N), bel]
+    # Round to 0.01, https://github.com/rafaelpadilla/Object-Detection-Metrics
+    tp = (
+      (iou.round(2)[:,None] >= iout - 1e-5)
+      & ((tbox[bel,4] == pbox[:,5]) & (bel < tnum) & (jnp.arange(N) < pnum))[:,None]
+    )  # shape=(N,len(iout))
+    # Remove duplicate belong: only the first (highest confidence) tp for each tbox is kept, \
+    # independently for each iou threshold.
+    K = iout.shape[0]
+    first = jnp.full((K, M), N, jnp.int32).at[jnp.arange(K)[None,:], bel[:,None]].min(
+      jnp.where(tp, jnp.arange(N)[:,None], N)
+    )  # first[k,j]: the first pbox index with tp belong to tbox[j]
+    tp = tp & (first[jnp.arange(K)[None,:], bel[:,None]] == jnp.arange(N)[:,None])
     return pbox, tp
 
-def load_pred_and_target_file(path_pred: Path, path_tg: Path, format='coco'):
-  cls2idx = {'_num': 0}
-  def load_file(path: Path):
-    box = []
-    with open(path, 'r') as file:
-      for line in file.readlines():
-        if len(line) == 0: continue
-        line = line.split()
-        if len(line) == 6:
-          cls, conf, x, y, w, h = [x if i == 0 else float(x) for i, x in enumerate(line)]
-        else:
-          cls, x, y, w, h = [x if i == 0 else float(x) for i, x in enumerate(line)]
-        if format == 'coco':
-          x += w / 2
-          y += h / 2
-        if cls not in cls2idx:
-          cls2idx[cls] = cls2idx['_num']; cls2idx['_num'] += 1
-        cls = cls2idx[cls]
-        if len(line) == 6:
-          box.append(jnp.stack([x, y, w, h, conf, cls]))
-        if len(line) == 5:
-          box.append(jnp.stack([x, y, w, h, cls]))
-    return jnp.stack(box)
-  def load_dir(path_dir: Path):
-    box, num = [], []
-    for path in sorted(path_dir.iterdir()):
-      if path.is_file():
-        box.append(load_file(path))
-        num.append(box[-1].shape[0])
-    for i in range(len(box)):
-      box[i] = jnp.pad(box[i], ((0, max(num) - box[i].shape[0]), (0, 0)))
-    return jnp.stack(box), jnp.stack(num)
-  pbox, pnum = load_dir(path_pred)
-  tbox, tnum = load_dir(path_tg)
+def _load_box_file(path: Path):
+  """
+  Parse a detection text file, each line is `cls conf x y w h` (predict) or `cls x y w h` (target).
+
+  Return:
+    cls: The class names of the boxes. [shape=(N,), dtype=str]
+    box: The numeric columns of the boxes. [shape=(N,5) or (N,4), dtype=float32]
+  """
+  with open(path, 'r') as file:
+    text = file.read().strip()
+  if len(text) == 0: return np.zeros(0, str), np.zeros((0, 0), np.float32)
+  ncol = len(text.split('\n', 1)[0].split())
+  tokens = np.array(text.split()).reshape(-1, ncol)
+  return tokens[:,0], tokens[:,1:].astype(np.float32)
+
+def load_pred_and_target_file(
+    path_pred: Path, path_tg: Path, format='coco',
+    num_workers: int = None, path_cache: Path = None
+  ):
+  """
+  Load the predict and target boxes from the text files in `path_pred` and `path_tg` directory, \
+  files are parsed in a process pool and padded to the maximum boxes number.
+
+  Args:
+    path_pred: The directory of predict files, each line is `cls conf x y w h`.
+    path_tg: The directory of target files, each line is `cls x y w h`.
+    format: If `coco`, the `(x,y)` is the left top corner, convert it to the center.
+    num_workers: The number of processes to parse the files, `0` parse in main process, \
+      `None` uses one process for every 2000 files (at most `os.cpu_count()`), \
+      since the spawned processes take seconds to start.
+    path_cache: The `.npz` cache file, `None` is `path_pred.parent/{path_pred.name}.cache.npz`. \
+      The cache is reused if the modify times of `path_pred` and `path_tg` are not changed.
+  Return:
+    pbox: The padded predict boxes. [shape=(B,N,6), elem=(x,y,w,h,conf,cls)]
+    pnum: The number of predict boxes in each file. [shape=(B,)]
+    tbox: The padded target boxes. [shape=(B,M,5), elem=(x,y,w,h,cls)]
+    tnum: The number of target boxes in each file. [shape=(B,)]
+    cls2idx: The mapping from class name to class index, `cls2idx['_num']` is the classes number.
+  """
+  path_pred, path_tg = Path(path_pred), Path(path_tg)
+  if path_cache is None:
+    path_cache = path_pred.parent / f"{path_pred.name}.cache.npz"
+  key = np.array([path_pred.stat().st_mtime_ns, path_tg.stat().st_mtime_ns, format == 'coco'], np.int64)
+  if path_cache.exists():
+    with np.load(path_cache) as cache:
+      if (cache['key'] == key).all():
+        cls2idx = {c: i for i, c in enumerate(cache['cls'].tolist())}
+        cls2idx['_num'] = len(cls2idx)
+        return cache['pbox'], cache['pnum'], cache['tbox'], cache['tnum'], cls2idx
+
+  paths = [sorted(p for p in d.iterdir() if p.is_file()) for d in (path_pred, path_tg)]
+  files = paths[0] + paths[1]
+  if num_workers is None: num_workers = min(os.cpu_count(), len(files) // 2000)
+  if num_workers == 0:
+    results = list(map(_load_box_file, files))
+  else:
+    # JAX is multithreaded, don't fork the process
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+      results = list(pool.map(_load_box_file, files, chunksize=64))
+  # Class index is given by the order of first appearance (predict files first)
+  names = np.concatenate([r[0] for r in results])
+  ucls, first, inv = np.unique(names, return_index=True, return_inverse=True)
+  order = np.argsort(first)
+  rank = np.empty_like(order); rank[order] = np.arange(len(order))
+  cls_idx = rank[inv].astype(np.float32)
+
+  def pad(results, cls_idx, ncol):
+    num = np.array([len(r[0]) for r in results], np.int32)
+    box = np.zeros((len(results), max(num.max(initial=0), 1), ncol), np.float32)
+    mask = np.arange(box.shape[1])[None,:] < num[:,None]
+    if num.sum():
+      box[mask] = np.concatenate([
+        np.concatenate([r[1], cls_idx[s:s+n,None]], -1)
+        for r, s, n in zip(results, np.cumsum(num) - num, num) if n
+      ])
+    if ncol == 6:  # (conf,x,y,w,h,cls) -> (x,y,w,h,conf,cls)
+      box = box[...,[1,2,3,4,0,5]]
+    if format == 'coco':
+      box[...,:2] += box[...,2:4] / 2
+    return box, num
+  n_pred = sum(len(r[0]) for r in results[:len(paths[0])])
+  pbox, pnum = pad(results[:len(paths[0])], cls_idx[:n_pred], 6)
+  tbox, tnum = pad(results[len(paths[0]):], cls_idx[n_pred:], 5)
+  np.savez_compressed(path_cache, key=key, cls=ucls[order], pbox=pbox, pnum=pnum, tbox=tbox, tnum=tnum)
+  cls2idx = {c: i for i, c in enumerate(ucls[order].tolist())}
+  cls2idx['_num'] = len(cls2idx)
   return pbox, pnum, tbox, tnum, cls2idx
 
 if __name__ == '__main__':
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : shm_loader.py
+@Desc    :
+Shared-memory batch transport for `YOLODataset`, a drop-in for the torch DataLoader
+(`DatasetBuilder.get_dataset(..., shm_transport=True)`):
+  - The workers are persistent, they are started once and kept for all the epochs.
+  - Each worker collates the batch (uint8 images, float32 boxes, int32 numbers) directly
+    into one slot of a ring of preallocated `SharedMemory` buffers, only the slot id and
+    the batch shapes go through the queue (no tensor pickling).
+  - The main process gets the numpy views of the slot (no copy).
+
+The arrays of one batch stay valid while the next `num_hold` batches are yielded, the slot
+is given back to the workers only when the `num_hold+1`-th next batch is yielded
+(`num_hold=4` covers `DevicePrefetcher(size=2)`, the async `jax.device_put` and one step
+still running asynchronously), copy it if it is kept for longer.
+
+There are `num_workers * prefetch_factor + num_hold + 1` slots, each one is a full batch
+in `/dev/shm`, e.g. 8 workers with 32 images of 640x640 use 13 x 40Mb.
+'''
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import math, random, traceback, queue
+
+from katacv.utils.yolo.build_dataset import YOLODataset, BucketCollate
+
+class _Slot:
+  """The views of one shared-memory buffer, `images`, `boxes` and `nums` are flat arrays."""
+  def __init__(self, shm: shared_memory.SharedMemory, img_size: int, box_size: int, batch_size: int):
+    self.shm = shm
+    self.images = np.ndarray((img_size,), np.uint8, shm.buf, 0)
+    self.boxes = np.ndarray((box_size,), np.float32, shm.buf, img_size)
+    self.nums = np.ndarray((batch_size,), np.int32, shm.buf, img_size + box_size * 4)
+
+  @staticmethod
+  def nbytes(img_size, box_size, batch_size):
+    return img_size + box_size * 4 + batch_size * 4
+
+  def views(self, img_shape, box_shape):
+    return (
+      self.images[:np.prod(img_shape)].reshape(img_shape),
+      self.boxes[:np.prod(box_shape)].reshape(box_shape),
+      self.nums[:img_shape[0]],
+    )
+
+def collate_into(slot: _Slot, samples, buckets=None):
+  """
+  Collate the samples `(img, box, num)` of `YOLODataset` into the slot.
+
+  Args:
+    buckets: The box buckets of `BucketCollate` if the boxes are not padded (`pad_box=False`).
+  Return:
+    img_shape, box_shape: The shapes of the batch in the slot.
+  """
+  n = len(samples)
+  img_shape = (n, *samples[0][0].shape)
+  max_num = max(num for _, _, num in samples)
+  size = buckets[np.searchsorted(buckets, max_num)] if buckets is not None else len(samples[0][1])
+  box_shape = (n, size, 5)
+  img, box, nums = slot.views(img_shape, box_shape)
+  box[...] = 0
+  for i, (x, b, num) in enumerate(samples):
+    img[i] = x
+    box[i,:num] = b[:num]
+    nums[i] = num
+  return img_shape, box_shape
+
+def _worker_loop(dataset, shm_names, sizes, buckets, task_queue, result_queue, seed):
+  random.seed(seed); np.random.seed(seed % 2 ** 32)
+  shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+  slots = [_Slot(shm, *sizes) for shm in shms]
+  while True:
+    task = task_queue.get()
+    if task is None: break
+    batch_id, slot_id, idxs = task
+    try:
+      shapes = collate_into(slots[slot_id], [dataset[i] for i in idxs], buckets)
+      result_queue.put((batch_id, slot_id, shapes, None))
+    except Exception:
+      result_queue.put((batch_id, slot_id, None, traceback.format_exc()))
+  del slots
+  for shm in shms: shm.close()
+
+class SharedMemoryLoader:
+  """
+  Args:
+    dataset: The `YOLODataset`, if `pad_box=False` the boxes are padded by the buckets of `BucketCollate`.
+    batch_size, shuffle, drop_last: Same as the torch DataLoader.
+    num_workers: The number of the persistent worker processes, `0` loads in the main process.
+    prefetch_factor: The number of the batches loading ahead in each worker.
+    num_hold: The number of the next yielded batches while one batch is kept valid (not overwritten).
+  """
+  def __init__(
+      self, dataset: YOLODataset, batch_size: int, shuffle=False,
+      num_workers=0, drop_last=True, prefetch_factor=1, num_hold=4
+    ):
+    self.dataset, self.batch_size, self.shuffle = dataset, batch_size, shuffle
+    self.num_workers, self.drop_last = num_workers, drop_last
+    self.num_slots = max(num_workers, 1) * prefetch_factor + num_hold + 1
+    self.num_hold = num_hold
+    self.buckets = None if dataset.pad_box else BucketCollate(dataset.max_num_box).buckets
+    self.workers, self.shms = [], []
+
+  def __len__(self):
+    n = len(self.dataset)
+    return n // self.batch_size if self.drop_last else math.ceil(n / self.batch_size)
+
+  def _max_sizes(self):
+    """The flat sizes of the images and boxes in one slot (the maximum batch shapes)."""
+    ds, s = self.dataset, self.dataset.img_size
+    h = w = 2 * s if ds.augment and ds.device_augment else s
+    if ds.rect_shapes is not None:
+      h, w = max(h, ds.rect_shapes[:,0].max()), max(w, ds.rect_shapes[:,1].max())
+    return self.batch_size * int(h) * int(w) * 3, self.batch_size * ds.max_num_box * 5, self.batch_size
+
+  def _start(self):
+    sizes = self._max_sizes()
+    nbytes = _Slot.nbytes(*sizes)
+    self.shms = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(self.num_slots)]
+    self.slots = [_Slot(shm, *sizes) for shm in self.shms]
+    if self.num_workers == 0: return
+    self.task_queue, self.result_queue = mp.Queue(), mp.Queue()
+    base_seed = random.getrandbits(32)
+    for i in range(self.num_workers):
+      worker = mp.Process(
+        target=_worker_loop, daemon=True, args=(
+          self.dataset, [shm.name for shm in self.shms], sizes,
+          self.buckets, self.task_queue, self.result_queue, base_seed + i
+        )
+      )
+      worker.start()
+      self.workers.append(worker)
+
+  def _get_result(self):
+    """Return `(batch_id, slot_id, shapes, error)` of one finished batch."""
+    while True:
+      try:
+        return self.result_queue.get(timeout=5)
+      except queue.Empty:
+        if not all(worker.is_alive() for worker in self.workers):
+          raise RuntimeError("SharedMemoryLoader worker exited unexpectedly")
+
+  def __iter__(self):
+    if not self.shms: self._start()
+    idxs = np.random.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+    batches = [idxs[i:i+self.batch_size].tolist() for i in range(0, len(idxs), self.batch_size)][:len(self)]
+    if self.num_workers == 0:
+      for i, batch in enumerate(batches):
+        slot = self.slots[i % self.num_slots]
+        shapes = collate_into(slot, [self.dataset[j] for j in batch], self.buckets)
+        yield slot.views(*shapes)
+      return
+    free = list(range(self.num_slots))
+    holding, done = [], {}  # yielded slots, finished batches (out of order)
+    num_sent = num_received = 0
+    def send():
+      nonlocal num_sent
+      while num_sent < len(batches) and len(free) > 0:
+        self.task_queue.put((num_sent, free.pop(), batches[num_sent]))
+        num_sent += 1
+    send()
+    try:
+      for batch_id in range(len(batches)):
+        while batch_id not in done:
+          i, slot_id, shapes, error = self._get_result()
+          num_received += 1
+          if error is not None:
+            raise RuntimeError(f"SharedMemoryLoader worker error:\n{error}")
+          done[i] = (slot_id, shapes)
+        slot_id, shapes = done.pop(batch_id)
+        holding.append(slot_id)
+        if len(holding) > self.num_hold + 1:  # the slot was yielded `num_hold+1` batches ago
+          free.append(holding.pop(0))
+        send()
+        yield self.slots[slot_id].views(*shapes)
+    finally:  # drain the sent batches if the iteration is stopped early
+      while num_received < num_sent and all(worker.is_alive() for worker in self.workers):
+        self._get_result()
+        num_received += 1
+
+  def close(self):
+    for _ in self.workers:
+      self.task_queue.put(None)
+    for worker in self.workers:
+      worker.join(timeout=5)
+      if worker.is_alive(): worker.terminate()
+    self.workers = []
+    self.slots = []
+    for shm in self.shms:
+      try:
+        shm.close()
+      except BufferError:  # the batch views are still used outside
+        pass
+      shm.unlink()
+    self.shms = []
+
+  def __del__(self):
+    try:
+      self.close()
+    except Exception:
+      pass
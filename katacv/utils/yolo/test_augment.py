@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : test_augment.py
+@Desc    :
+Compare the on-device augmentation in `augment.py` with cv2 and the identity transform.
+Run: python -m pytest katacv/utils/yolo/test_augment.py
+'''
+import numpy as np
+import jax, jax.numpy as jnp
+import cv2
+
+from katacv.utils.yolo.augment import rgb2hsv, hsv2rgb, augment_batch
+
+def test_rgb2hsv():
+  rng = np.random.default_rng(0)
+  x = rng.uniform(0, 1, (64, 64, 3)).astype(np.float32)
+  x[0,:8] = [[0,0,0], [1,1,1], [0.5,0.5,0.5], [1,0,0], [0,1,0], [0,0,1], [1,1,0], [1,0,1]]  # gray and pure colors
+  hsv = cv2.cvtColor(x, cv2.COLOR_RGB2HSV)  # h in [0,360)
+  y = np.asarray(rgb2hsv(jnp.asarray(x)))
+  dh = np.abs(y[...,0] * 360 - hsv[...,0])
+  assert np.minimum(dh, 360 - dh).max() < 1e-2
+  np.testing.assert_allclose(y[...,1:], hsv[...,1:], atol=1e-5)
+  np.testing.assert_allclose(np.asarray(hsv2rgb(rgb2hsv(jnp.asarray(x)))), x, atol=1e-5)
+
+def random_batch(rng, N=4, M=10, size=64):
+  x = rng.integers(0, 256, (N, 2 * size, 2 * size, 3), dtype=np.uint8)
+  xy = rng.uniform(size // 2 + 10, size * 3 // 2 - 10, (N, M, 2))
+  wh = rng.uniform(8, 20, (N, M, 2))
+  wh[:,1::3] = 1  # too small, filtered
+  cls = rng.integers(0, 80, (N, M, 1))
+  tnum = rng.integers(0, M + 1, N)
+  tbox = np.concatenate([xy, wh, cls], -1).astype(np.float32)
+  return x, tbox, tnum
+
+def expected_box(tbox, tnum, border, flip_width=None):
+  """The boxes without affine: shift by the border, drop the small ones and keep the order."""
+  box = tbox[:tnum].copy()
+  box[:,:2] -= border
+  if flip_width is not None: box[:,0] = flip_width - box[:,0]
+  return box[(box[:,2] > 2) & (box[:,3] > 2)]
+
+def test_augment_identity():
+  """No affine, HSV or flip, the output is the center crop and the shifted boxes (valid ones first)."""
+  rng = np.random.default_rng(0)
+  x, tbox, tnum = random_batch(rng)
+  border = x.shape[1] // 4
+  for fliplr in [0.0, 1.0]:
+    y, box, num = augment_batch(
+      jax.random.PRNGKey(0), x, tbox, tnum, hsv=(0.0, 0.0, 0.0),
+      fliplr=fliplr, rot=0.0, scale=0.0, shear=0.0, translate=0.0
+    )
+    y, box, num = np.asarray(y), np.asarray(box), np.asarray(num)
+    crop = x[:,border:-border,border:-border] / 255
+    if fliplr: crop = crop[:,:,::-1]
+    np.testing.assert_allclose(y, crop, atol=1e-5)
+    for i in range(len(x)):
+      ref = expected_box(tbox[i], tnum[i], border, crop.shape[2] if fliplr else None)
+      assert num[i] == len(ref)
+      np.testing.assert_allclose(box[i,:num[i]], ref, atol=1e-3)
+      np.testing.assert_array_equal(box[i,num[i]:], 0)
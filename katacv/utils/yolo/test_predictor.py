@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : test_predictor.py
+@Desc    :
+Compare `BasePredictor.compute_tp` with the plain numpy loop of the same matching rule.
+Run: python -m pytest katacv/utils/yolo/test_predictor.py
+'''
+import numpy as np
+import jax.numpy as jnp
+import pytest
+
+from katacv.utils.detection import iou_multiply
+from katacv.utils.yolo.predictor import BasePredictor
+
+def compute_tp_ref(pbox, pnum, tbox, tnum, iout):
+  """(Numpy) Match the boxes one by one in decreasing confidence, each target is matched once for each iou threshold."""
+  pbox = pbox[np.argsort(-pbox[:,4], kind='stable')]
+  tp = np.zeros((len(pbox), len(iout)), np.bool_)
+  if tnum == 0: return pbox, tp
+  ious = np.asarray(iou_multiply(jnp.asarray(pbox[:,:4]), jnp.asarray(tbox[:,:4])))
+  used = np.zeros((len(tbox), len(iout)), np.bool_)
+  for i in range(pnum):
+    j = np.argmax((tbox[:,4] == pbox[i,5]) * ious[i])  # the best target with the same class
+    if tbox[j,4] != pbox[i,5] or j >= tnum: continue
+    tp[i] = (ious[i,j].round(2) >= iout - 1e-5) & ~used[j]
+    used[j] |= tp[i]
+  return pbox, tp
+
+def random_case(rng, N=60, M=20, num_classes=3):
+  """Padded `pbox` and `tbox`, the predicted boxes are jittered copies of the targets (duplicates included)."""
+  tnum, pnum = int(rng.integers(0, M + 1)), int(rng.integers(0, N + 1))
+  tbox = np.zeros((M, 5), np.float32)
+  tbox[:tnum,:2] = rng.uniform(0, 200, (tnum, 2))
+  tbox[:tnum,2:4] = rng.uniform(10, 50, (tnum, 2))
+  tbox[:tnum,4] = rng.integers(0, num_classes, tnum)
+  pbox = np.zeros((N, 6), np.float32)
+  src = tbox[rng.integers(0, max(tnum, 1), pnum)]
+  pbox[:pnum,:2] = src[:,:2] + rng.normal(0, 3, (pnum, 2))
+  pbox[:pnum,2:4] = src[:,2:4] * rng.uniform(0.8, 1.2, (pnum, 2))
+  pbox[:pnum,4] = rng.uniform(0.01, 1, pnum)
+  pbox[:pnum,5] = np.where(rng.uniform(size=pnum) < 0.8, src[:,4], rng.integers(0, num_classes, pnum))
+  return pbox, pnum, tbox, tnum
+
+@pytest.mark.parametrize('num_iout', [1, 10])
+def test_compute_tp(num_iout):
+  rng = np.random.default_rng(num_iout)
+  iout = np.linspace(0.5, 0.95, num_iout).astype(np.float32)
+  for _ in range(100):
+    pbox, pnum, tbox, tnum = random_case(rng)
+    pbox_sort, tp = BasePredictor.compute_tp(pbox, pnum, tbox, tnum, jnp.asarray(iout))
+    ref_pbox, ref_tp = compute_tp_ref(pbox, pnum, tbox, tnum, iout)
+    np.testing.assert_array_equal(np.asarray(pbox_sort), ref_pbox)
+    np.testing.assert_array_equal(np.asarray(tp), ref_tp)
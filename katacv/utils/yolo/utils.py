@@ -2,8 +2,12 @@ import numpy as np
 import cv2
 import random
 import math
+import functools
+from pathlib import Path
 from PIL import Image
 
+path_default_font = Path(__file__).parents[1] / "fonts/Consolas.ttf"
+
 def xywh2xyxy(box):
   box[:, 2] = box[:, 0] + box[:, 2]
   box[:, 3] = box[:, 1] + box[:, 3]
@@ -36,19 +40,27 @@ def box_filter_idxs(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-6):
   area = w2 * h2 / (w1 * h1 + eps)  # area ratio
   return (w2 > wh_thr) & (h2 > wh_thr) & (area > area_thr) & (ar < ar_thr)
 
-def transform_affine(
-    img, box,       # |   unit       |  random  |   suggestion range |
+def get_affine_matrix(
+    shape,          # |   unit       |  random  |   suggestion range |
     rot=0,          # |  degree      |   +/-    |     [0.0, 45.0]    |
     scale=0.5,      # |  wh scale    |   +/-    |     [0.0, 1.0]     |
     shear=0,        # |  wh degree   |   +/-    |     [0, 45]        |
     translate=0.1,  # |  fraction    |   +/-    |     [0, 0.5]       |
     border=0
 ):
-  h = img.shape[0] - border * 2
-  w = img.shape[1] - border * 2
+  """
+  Sample a random affine matrix for the image with `shape`.
+
+  Return:
+    M: The affine matrix from input image to output. [shape=(3,3)]
+    (w, h): The output image size.
+    scale: The sampled scale.
+  """
+  h = shape[0] - border * 2
+  w = shape[1] - border * 2
   C = np.eye(3)  # Center
-  C[0, 2] = -img.shape[1] / 2
-  C[1, 2] = -img.shape[0] / 2
+  C[0, 2] = -shape[1] / 2
+  C[1, 2] = -shape[0] / 2
 
   R = np.eye(3)  # Rotation and Scale
   theta = random.uniform(-rot, rot)
@@ -65,10 +77,12 @@ def transform_affine(
   T[0, 2] = random.uniform(0.5 - translate, 0.5 + translate) * w
   T[1, 2] = random.uniform(0.5 - translate, 0.5 + translate) * h
 
-  M = T @ S @ R @ C
-  img = cv2.warpAffine(img, M[:2], dsize=(w, h), borderValue=(114,114,114))
+  return T @ S @ R @ C, (w, h), scale
+
+def affine_box(box, M, w, h, scale):
+  """Transform the `box` (x1,y1,x2,y2,cls) by affine matrix `M`, clip to `(w,h)` and filter the small boxes."""
   nb = len(box)
-  if len(box):
+  if nb:
     xy = np.ones((nb * 4, 3))
     xy[:, :2] = box[:, [0,1,2,3,0,3,2,1]].reshape(nb * 4, 2)  # x1y1, x2y2, x1y2, x2y1
     xy = (xy @ M.T)[:, :2].reshape(nb, 8)
@@ -79,7 +93,40 @@ def transform_affine(
     new[:, [1, 3]] = new[:, [1, 3]].clip(0, h)
     idxs = box_filter_idxs(box[:, :4] * scale, new)
     box = np.concatenate([new[idxs], box[idxs,4:5]], axis=-1)
-  return img, box
+  return box
+
+def transform_affine(img, box, rot=0, scale=0.5, shear=0, translate=0.1, border=0):
+  M, (w, h), scale = get_affine_matrix(img.shape, rot, scale, shear, translate, border)
+  img = cv2.warpAffine(img, M[:2], dsize=(w, h), borderValue=(114,114,114))
+  return img, affine_box(box, M, w, h, scale)
+
+def transform_affine_tiles(tiles, shape, box, rot=0, scale=0.5, shear=0, translate=0.1, border=0):
+  """
+  Same as `transform_affine` on the image of `shape` composed by `tiles`, \
+  but each tile is warped directly into the output (the composed image is never built).
+
+  Args:
+    tiles: List of `(img, (x, y))`, `img` is placed at the left top `(x,y)` of the composed image.
+    shape: The shape of the composed image, the area without tile is filled by 114.
+  """
+  M, (w, h), scale = get_affine_matrix(shape, rot, scale, shear, translate, border)
+  out = np.full((h, w, 3), 114, dtype=np.uint8)
+  for img, (x, y) in tiles:
+    th, tw = img.shape[:2]
+    if th == 0 or tw == 0: continue
+    Mt = M @ np.array([[1, 0, x], [0, 1, y], [0, 0, 1]])  # tile -> output
+    corners = np.array([[0, 0, 1], [tw, 0, 1], [0, th, 1], [tw, th, 1]]) @ Mt.T
+    x1, y1 = np.floor(corners[:, :2].min(0)).astype(int).clip(0, [w, h])
+    x2, y2 = np.ceil(corners[:, :2].max(0)).astype(int).clip(0, [w, h])
+    if x1 >= x2 or y1 >= y2: continue
+    Mt = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]]) @ Mt  # only warp the bounding region of the tile
+    # BORDER_TRANSPARENT keeps the pixels of `dst` outside the tile, write back explicitly \
+    # since the bindings may reallocate `dst` for a non-contiguous view
+    out[y1:y2, x1:x2] = cv2.warpAffine(
+      img, Mt[:2], dsize=(x2-x1, y2-y1), dst=out[y1:y2, x1:x2].copy(),
+      borderMode=cv2.BORDER_TRANSPARENT
+    )
+  return out, affine_box(box, M, w, h, scale)
 
 def transform_hsv(img, h=0.015, s=0.7, v=0.4):
   r = np.random.uniform(-1, 1, 3) * [h, s, v] + 1
@@ -99,27 +146,103 @@ def transform_pad(img, target_shape):
   img = np.pad(img, ((top, bottom), (left, right), (0, 0)), mode="constant", constant_values=114)
   return img, (top, left)
 
-def show_box(img, box, draw_center_point=False, verbose=True, format='yolo', video=False, drop_text=False):
-  from katacv.utils.detection import plot_box_PIL, build_label2colors
-  from katacv.utils.coco.constant import label2name
-  img = img.copy()
-  if isinstance(img, np.ndarray):
-    if img.max() <= 1.0: img *= 255
-    img = Image.fromarray(img.astype('uint8'))
+@functools.lru_cache(maxsize=None)
+def get_glyphs(fontpath=path_default_font, fontsize=14):
+  """
+  (Cached) Render each printable ASCII character by the font only once.
+
+  Return:
+    glyphs: Mapping from the character to its alpha mask. [dtype=uint8, shape=(ascent+descent,advance)]
+  """
+  from PIL import ImageFont, ImageDraw
+  font = ImageFont.truetype(str(fontpath), fontsize)
+  ascent, descent = font.getmetrics()
+  glyphs = {}
+  for c in map(chr, range(32, 127)):
+    mask = Image.new('L', (max(int(round(font.getlength(c))), 1), ascent + descent))
+    ImageDraw.Draw(mask).text((0, 0), c, fill=255, font=font)
+    glyphs[c] = np.array(mask)
+  return glyphs
+
+@functools.lru_cache(maxsize=None)
+def get_label_colors(num_classes):
+  """(Cached) The box color of each label. [dtype=uint8, shape=(num_classes,3)]"""
+  from katacv.utils.detection import get_box_colors
+  return np.array(get_box_colors(num_classes), np.uint8)[:num_classes]
+
+def draw_text(img, text, xy, color, glyphs):
+  """
+  (cv2) Draw white `text` with background `color` on the upper of point `xy` \
+  (or lower if out of image) by the cached `glyphs`, `img` is changed in place.
+  """
+  mask = np.concatenate([glyphs.get(c, glyphs['?']) for c in text], 1)
+  h, w = mask.shape
+  x, y = xy
+  y = y - h if y > h else y
+  x1, y1, x2, y2 = max(x, 0), max(y, 0), min(x + w, img.shape[1]), min(y + h, img.shape[0])
+  if x1 >= x2 or y1 >= y2: return img
+  alpha = mask[y1-y:y2-y, x1-x:x2-x, None].astype(np.uint16)
+  bg = np.array(color, np.uint16)
+  img[y1:y2, x1:x2] = ((bg * (255 - alpha) + 255 * alpha) // 255).astype(np.uint8)
+  return img
+
+def plot_boxes(
+    img, box, format='yolo', draw_center_point=False, drop_text=False,
+    fontpath=path_default_font, fontsize=14, label2name=None, copy=True
+  ):
+  """
+  (cv2) Draw all the boxes of a frame on the uint8 image in one pass, \
+  the fonts and label colors are cached in the process.
+
+  Args:
+    img: The image. [shape=(H,W,3), dtype=uint8 or float in [0,1]]
+    box: The boxes in pixel (or proportion if all values <= 1). \
+      [shape=(N,6), elem=(x,y,w,h,conf,cls)] or [shape=(N,5), elem=(x,y,w,h,cls)]
+    format: `yolo`, `coco` or `voc`, same as `plot_box_PIL`.
+    label2name: Mapping from label to name, `None` is the COCO names.
+    copy: If `False` and `img` is a uint8 array, draw on `img` in place.
+  Return:
+    img: The image with boxes. [shape=(H,W,3), dtype=uint8]
+  """
+  if label2name is None:
+    from katacv.utils.coco.constant import label2name
+  img = np.asarray(img)
+  if img.dtype != np.uint8:
+    img = (img * 255 if img.max() <= 1.0 else img).astype(np.uint8)
+  elif copy:
+    img = img.copy()
+  img = np.ascontiguousarray(img)
+  box = np.asarray(box, np.float32)
+  if len(box) == 0: return img
   label_idx, conf_idx = (4, None) if box.shape[1] == 5 else (5, 4)
-  if len(box):
-    label2color = build_label2colors(box[:,label_idx])
-    if video:
-      label2color = build_label2colors(list(label2name.keys()))
-  for b in box:
-    conf = float(b[conf_idx]) if conf_idx != None else None
-    label = int(b[label_idx])
-    img = plot_box_PIL(
-      img, b[:4],
-      text=f"{label2name[label]}{f' {conf:.3f}' if conf else ''}" if not drop_text else "",
-      box_color=label2color[label],
-      format=format, draw_center_point=draw_center_point
-    )
+  xyxy = box[:,:4].copy()
+  if xyxy.max() <= 1.0:
+    xyxy *= np.array([img.shape[1], img.shape[0]] * 2, np.float32)
+  if format.lower() == 'yolo':
+    xyxy[:,:2] -= xyxy[:,2:] / 2
+  if format.lower() in ['yolo', 'coco']:
+    xyxy[:,2:] += xyxy[:,:2]
+  xyxy = xyxy.astype(np.int32).tolist()
+  colors = get_label_colors(len(label2name)).tolist()
+  glyphs = get_glyphs(fontpath, fontsize)
+  labels = box[:,label_idx].astype(np.int32).tolist()
+  confs = box[:,conf_idx].tolist() if conf_idx is not None else [None] * len(box)
+  for (x1, y1, x2, y2), label, conf in zip(xyxy, labels, confs):
+    color = colors[label % len(colors)]
+    cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+    if not drop_text:
+      draw_text(img, f"{label2name[label]}{f' {conf:.3f}' if conf else ''}", (x1, y1), color, glyphs)
+    if draw_center_point:
+      xc, yc = (x1 + x2) // 2, (y1 + y2) // 2
+      cv2.rectangle(img, (xc-2, yc-2), (xc+2, yc+2), (255,0,0), -1)
+  return img
+
+def show_box(img, box, draw_center_point=False, verbose=True, format='yolo', video=False, drop_text=False):
+  """
+  Draw the boxes by `plot_boxes` and return a PIL image. \
+  The label colors are fixed for all the COCO labels, so `video` is only kept for compatibility.
+  """
+  img = Image.fromarray(plot_boxes(img, box, format, draw_center_point, drop_text))
   if verbose:
     img.show()
   return img
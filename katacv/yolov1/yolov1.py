@@ -6,6 +6,7 @@ from flax.training import train_state
 import optax
 from katacv.yolov1.yolov1_pretrain import Darknet, ConvBlock, partial
 from katacv.utils.logs import Logs, MeanMetric
+from katacv.utils.device_prefetch import DevicePrefetcher
 from pathlib import Path
 from typing import Callable
 
@@ -187,15 +188,15 @@ def model_step(state: TrainState, x, y, train: bool = True):
         loss, (_, metrics) = loss_fn(state.params)
     return state, (loss, *metrics)
 
-from katacv.utils.detection import nms, mAP, coco_mAP, get_best_boxes_and_classes
+from katacv.utils.detection import nms, mAP_multi_threshold, get_best_boxes_and_classes
 
 import numpy as np
 def get_nms_boxes_mAP_coco_mAP(cells, target):
     boxes = get_best_boxes_and_classes(cells, args.S, args.B, args.C)  # NxMx6
     boxes = [nms(boxes[i], iou_threshold=0.5, conf_threshold=0.4) for i in range(boxes.shape[0])]  # NxM'x6
     target_boxes = jnp.concatenate([target[...,20:],jnp.argmax(target[...,:20],-1,keepdims=True)],-1).reshape(target.shape[0],-1,6)  # Nx(SxS)x6
-    _mAP = np.mean([mAP(boxes[i], target_boxes[i], iou_threshold=0.5) for i in range(len(boxes))])
-    _coco_mAP = np.mean([coco_mAP(boxes[i], target_boxes[i]) for i in range(len(boxes))])
+    mAPs = np.array([mAP_multi_threshold(boxes[i], target_boxes[i], 0.5+jnp.arange(10)*0.05) for i in range(len(boxes))])  # Nx10
+    _mAP, _coco_mAP = mAPs[:,0].mean(), mAPs.mean()
     return boxes, _mAP, _coco_mAP
 
 if __name__ == '__main__':
@@ -236,9 +237,8 @@ if __name__ == '__main__':
             print(f"epoch: {epoch}/{args.total_epochs}")
             logs.reset()
             print("training...")
-            for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
+            for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
             # for x, y in tqdm(train_ds.take(300), total=300, desc="Processing"):
-                x, y = x.numpy(), y.numpy()
                 global_step += 1
                 state, metrics = model_step(state, x, y)
                 # print(len(metrics))
@@ -257,8 +257,7 @@ if __name__ == '__main__':
 
             logs.reset()
             print("validating...")
-            for x, y in tqdm(val_ds, total=val_ds_size, desc="Processing"):
-                x, y = x.numpy(), y.numpy()
+            for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size, desc="Processing"):
                 state, metrics = model_step(state, x, y, train=False)
                 # boxes, *mAP_coco_mAP = get_nms_boxes_mAP_coco_mAP(cells, y)
                 logs.update(
@@ -276,8 +275,7 @@ if __name__ == '__main__':
     elif args.evaluate:
         logs.reset()
         print("evalute train data...")
-        for x, y in tqdm(train_ds, total=train_ds_size, desc="Processing"):
-            x, y = x.numpy(), y.numpy()
+        for x, y in tqdm(DevicePrefetcher(train_ds), total=train_ds_size, desc="Processing"):
             global_step += 1
             state, (*metrics, cells) = model_step(state, x, y, train=False)
             # boxes, *mAP_coco_mAP = get_nms_boxes_mAP_coco_mAP(cells, y)
@@ -294,8 +292,7 @@ if __name__ == '__main__':
                 logs.writer_tensorboard(writer, global_step)
 
         print("evalute val data...")
-        for x, y in tqdm(val_ds, total=val_ds_size, desc="Processing"):
-            x, y = x.numpy(), y.numpy()
+        for x, y in tqdm(DevicePrefetcher(val_ds), total=val_ds_size, desc="Processing"):
             state, (*metrics, cells) = model_step(state, x, y, train=False)
             # boxes, *mAP_coco_mAP = get_nms_boxes_mAP_coco_mAP(cells, y)
             logs.update(
@@ -35,6 +35,7 @@ import sys, os
 sys.path.append(os.getcwd())
 from katacv.utils.related_pkgs.utility import *
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 from katacv.yolov3.logs import logs
 
 from katacv.yolov3.yolov3_model import TrainState
@@ -170,6 +171,7 @@ if __name__ == '__main__':
     ds_builder = DatasetBuilder(args)
     train_ds, train_ds_size = ds_builder.get_dataset('train')
     val_ds, val_ds_size = ds_builder.get_dataset('val')
+    split = lambda x, y: (x, split_targets(y, args))  # split the targets on device
 
     ### Train and evaluate ###
     start_time, global_step = time.time(), 0
@@ -178,8 +180,7 @@ if __name__ == '__main__':
             print(f"epoch: {epoch}/{args.total_epochs}")
             print("training...")
             logs.reset()
-            for x, y in tqdm(train_ds, total=train_ds_size):
-                x = x.numpy(); y = split_targets(y, args)
+            for x, y in tqdm(DevicePrefetcher(train_ds, transform=split), total=train_ds_size):
                 global_step += 1
                 state, metrics = model_step(state, x, y, train=True)
                 logs.update(
@@ -208,8 +209,7 @@ if __name__ == '__main__':
             
             logs.reset()
             print("validating...")
-            for x, y in tqdm(val_ds, total=val_ds_size):
-                x = x.numpy(); y = split_targets(y, args)
+            for x, y in tqdm(DevicePrefetcher(val_ds, transform=split), total=val_ds_size):
                 _, metrics = model_step(state, x, y, train=False)
                 logs.update(
                     [
@@ -71,6 +71,7 @@ class Predictor:
       pbox, pnum, tp = jax.device_get(self.pred_and_nms_and_tp(
         x, nms_iou, nms_conf, tbox, tnum
       ))
+      tbox, tnum = np.asarray(tbox), np.asarray(tnum)  # maybe on device
     for i in range(x.shape[0]):
       self.pbox.append(pbox[i][:pnum[i]])
       self.tcls.append(tbox[i][:tnum[i],4].astype(np.int32))
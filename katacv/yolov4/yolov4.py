@@ -27,6 +27,7 @@ import sys, os
 sys.path.append(os.getcwd())
 from katacv.utils.related_pkgs.utility import *
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
+from katacv.utils.device_prefetch import DevicePrefetcher
 
 from katacv.utils.imagenet.train import TrainState
 from katacv.utils.detection import iou
@@ -184,10 +185,9 @@ if __name__ == '__main__':
       print(f"epoch: {epoch}/{args.total_epochs}")
       print("training...")
       logs.reset()
-      bar = tqdm(train_ds)
+      bar = tqdm(DevicePrefetcher(train_ds))
       # num_objs = []
       for x, tbox, tnum in bar:
-        x, tbox, tnum = x.numpy(), tbox.numpy(), tnum.numpy()
         global_step += 1
         state, (loss, pred_pixel, other_losses) = model_step(state, x, tbox, tnum, train=True)
         # num_objs.append(int(num_obj))
@@ -210,8 +210,7 @@ if __name__ == '__main__':
           logs.reset()
       print("validating...")
       logs.reset()
-      for x, tbox, tnum in tqdm(val_ds):
-        x, tbox, tnum = x.numpy(), tbox.numpy(), tnum.numpy()
+      for x, tbox, tnum in tqdm(DevicePrefetcher(val_ds)):
         predictor.update(x, tbox, tnum)
       p50, r50, ap50, ap75, map = predictor.p_r_ap50_ap75_map()
       logs.update(
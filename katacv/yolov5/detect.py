@@ -85,8 +85,9 @@ class ImageAndVideoLoader:
     return path, img, self.cap, s
   
 class Infer:
-  def __init__(self, model_name="YOLOv5", load_id=300, path_model=None, iou_thre=0.4, conf_thre=0.5, **kwargs):
+  def __init__(self, model_name="YOLOv5", load_id=300, path_model=None, iou_thre=0.4, conf_thre=0.5, class_aware=False, nms_mode='greedy', topk=None, **kwargs):
     self.iou_thre, self.conf_thre = iou_thre, conf_thre
+    self.class_aware, self.nms_mode = class_aware, nms_mode
     from katacv.yolov5.parser import get_args_and_writer
     self.args = get_args_and_writer(no_writer=True, input_args=f"--model-name {model_name} --load-id {load_id} --batch-size 1".split())
 
@@ -106,7 +107,7 @@ class Infer:
       self.state = load_weights_orbax(self.state, path_model)
     
     from katacv.yolov5.predict import Predictor
-    self.predictor = Predictor(self.args, self.state)
+    self.predictor = Predictor(self.args, self.state, topk=topk)
   
   @partial(jax.jit, static_argnums=[0])
   def preprocess(self, x):
@@ -116,7 +117,7 @@ class Infer:
     w = jnp.r_[w, w, [1] * 3].reshape(1,1,7)
     x = jnp.array(x, dtype=jnp.float32) / 255.
     x = jax.image.resize(x, (x.shape[0], *self.args.image_shape), method="trilinear")
-    pbox, pnum = self.predictor.pred_and_nms(self.state, x, iou_threshold=self.iou_thre, conf_threshold=self.conf_thre, nms_multi=10)
+    pbox, pnum = self.predictor.pred_and_nms(self.state, x, iou_threshold=self.iou_thre, conf_threshold=self.conf_thre, nms_multi=10, class_aware=self.class_aware, nms_mode=self.nms_mode)
     pbox = pbox * w
     return pbox, pnum
   
@@ -135,9 +136,15 @@ def parse_args(input_args=None):
     help="The id of loaded model")
   parser.add_argument("--path-model", type=str, default=None,
     help="The checkpoint directory of the model")
+  parser.add_argument("--class-aware", action='store_true',
+    help="If taggled, NMS is computed for each class independently")
+  parser.add_argument("--nms-mode", type=str, default='greedy', choices=['greedy', 'matrix'],
+    help="The NMS backend, 'greedy' is exact greedy NMS, 'matrix' is parallel Matrix NMS")
+  parser.add_argument("--topk", type=int, default=None,
+    help="If given, only decode the top k boxes by objectness in each scale before NMS")
   return parser.parse_args(input_args)
 
-from katacv.utils.yolo.utils import show_box
+from katacv.utils.yolo.utils import plot_boxes
 def process(args):
   path = str(args.path)
   is_file = path.rsplit('.', 1)[-1] in (['txt'] + IMG_FORMATS + VID_FORMATS)
@@ -154,10 +161,10 @@ def process(args):
       pbox = infer(x)
     for i, box in enumerate(pbox):
       if ds.mode in ['image', 'video']:
-        img = show_box(x[i], box, verbose=False)
+        img = plot_boxes(x[i], box)
         save_path = str(save_dir / Path(p).name)
         if ds.mode == 'image':
-          img.save(save_path)
+          Image.fromarray(img).save(save_path)
         else:  # video
           if vid_path != save_path:  # new video
             vid_path = save_path
@@ -169,7 +176,7 @@ def process(args):
               h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             save_path = str(Path(save_path).with_suffix('.mp4'))
             vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-          vid_writer.write(np.array(img))
+          vid_writer.write(img)
       print(f"{s} {sw.dt * 1e3:.1f}ms")
 
 if __name__ == '__main__':
@@ -21,6 +21,7 @@ class ComputeLoss:
     self.coef_cls = args.coef_cls
     self.balance_obj = [4.0, 1.0, 0.4]
     self.aspect_ratio_thre = 4.0
+    self.sparse = args.sparse_loss  # box and class loss only on the positive targets
     self.offset = jnp.array(
       [(0, 0), (-1, 0), (1, 0), (0, 1), (0, -1)], dtype=jnp.float32
     ) * 0.5
@@ -58,16 +59,47 @@ class ComputeLoss:
       hot = jax.nn.one_hot(t[..., 5], self.nc)
       lcls = BCE(p[..., 5:], hot, mask)
       return lbox, lobj, lcls
+
+    def sparse_loss_fn(p, idx, t, anchors):
+      """
+      Same as `single_loss_fn`, but the box and class losses are only calculated on the positives.
+      Args:
+        p (logits): [shape=(N,3,H,W,5+nc)]
+        idx (positive idxs): The flatten idxs in `(3,H,W)`, padding is `3*H*W`. [shape=(N,K)]
+        t (target): The targets of `idx`. [shape=(N,K,6)]
+        anchors: [shape=(3,2)]
+      """
+      N, A, H, W, C = p.shape
+      p = p.reshape(N, A*H*W, C)
+      mask = (idx < A*H*W)[..., None]  # positive mask
+      i = jnp.minimum(idx, A*H*W-1)
+      pp = jnp.take_along_axis(p, i[..., None], axis=1)  # shape=(N,K,5+nc)
+      xy = (jax.nn.sigmoid(pp[...,:2]) - 0.5) * 2.0 + 0.5
+      wh = (jax.nn.sigmoid(pp[...,2:4]) * 2) ** 2 * anchors[i // (H*W)]
+      ious = iou(jnp.concatenate([xy, wh], -1), t[..., :4], format='ciou', keepdim=True)
+      lbox = (mask * (1 - ious)).sum() / mask.sum()
+      ious = jax.lax.stop_gradient(ious)
+      tobj = jnp.zeros((N, A*H*W, 1)).at[jnp.arange(N)[:,None], idx].set(
+        mask * jnp.clip(ious, 0.0), mode='drop'  # padding is dropped
+      )
+      lobj = BCE(p[..., 4:5], tobj, jnp.ones_like(tobj))
+      hot = jax.nn.one_hot(t[..., 5], self.nc)
+      lcls = BCE(pp[..., 5:], hot, mask)
+      return lbox, lobj, lcls
     
     def loss_fn(params):
       logits, updates = state.apply_fn(
         {'params': params, 'batch_stats': state.batch_stats},
         x, train=train, mutable=['batch_stats']  # Update (2024.1.1): train=train
       )
-      targets = jax.vmap(self.build_target)(logits, box, nb)
+      targets = jax.vmap(partial(self.build_target, sparse=self.sparse))(logits, box, nb)
       lbox, lobj, lcls = 0, 0, 0
       for i in range(3):
-        losses = single_loss_fn(logits[i], targets[i], self.anchors[i] / (2**(i+3)))  # Update(2023.12.27): wh relative to cell
+        anchors = self.anchors[i] / (2**(i+3))  # Update(2023.12.27): wh relative to cell
+        if self.sparse:
+          losses = sparse_loss_fn(logits[i], *targets[i], anchors)
+        else:
+          losses = single_loss_fn(logits[i], targets[i], anchors)
         lbox += losses[0]
         lobj += losses[1] * self.balance_obj[i]
         lcls += losses[2]
@@ -86,41 +118,57 @@ class ComputeLoss:
       loss, (_, *metrics) = loss_fn(state.params)
     return state, (loss, *metrics)
   
-  @partial(jax.jit, static_argnums=0)
-  def build_target(self, p: List[jnp.ndarray], box: jnp.ndarray, nb: int):
+  @partial(jax.jit, static_argnums=0, static_argnames='sparse')
+  def build_target(self, p: List[jnp.ndarray], box: jnp.ndarray, nb: int, sparse: bool = False):
     """
-    Build target for one sample.
+    Build target for one sample, all the (box, offset, anchor) candidates of one scale \
+    are written by one scatter (max of the write order, so the last valid candidate wins).
     Args:
       p (logits): list[shape=(3,Hi,Wi,5+nc)], i=0,1,2, \
         [elem: (x,y,w,h,conf,*prob)]
       box: Target boxes with YOLO format. [shape=(M,5)]
       nb: Number of the target box.
+      sparse: Return the positive targets only.
     Return:
       target: Target for `p` cell format. \
         list[shape=(3,Hi,Wi,6)], i=0,1,2, [elem: (x,y,w,h,conf,cls)]
+      (sparse) target: The positive idxs and their targets, the capacity is \
+        `K=min(M*5*3, 3*Hi*Wi)` (no positive is lost), the padding idx is `3*Hi*Wi`. \
+        list[(shape=(K,), shape=(K,6))], i=0,1,2
     """
-    target = [jnp.zeros((*p[i].shape[:3],6)) for i in range(3)]
-    def loop_i_fn(i, target):  # box[i]
-      b, cls = box[i, :4], box[i, 4]
-      rate = b[None,None,2:4] / self.anchors  # anchors.shape=(3,3,2)
-      flag = jnp.maximum(rate, 1.0 / rate).max(-1) < self.aspect_ratio_thre  # shape=(3,3)
-
-      def update_fn(value):
-        t, k, c, bc = value
-        t = t.at[k,c[1],c[0]].set(jnp.r_[bc, 1, cls])
-        return t
-
-      for j in range(3):  # diff scale
-        s = 2 ** (j+3)
-        cs = (self.offset + b[:2] / s).astype(jnp.int32)  # center in cells, shape=(5,2)
-        for c in cs:  # add target to near cell
-          for k in range(3):  # diff anchor in current scale
-            bc = jnp.r_[b[:2]/s - c.astype(jnp.float32), b[2:4]/s]  # Update 2023.12.27: wh should relative to cell
-            target[j] = jax.lax.cond(
-              flag[j,k], update_fn, lambda x: x[0], (target[j], k, c, bc)
-            )
-      return target
-    target = jax.lax.fori_loop(0, nb, loop_i_fn, target)
+    M = box.shape[0]
+    b, cls = box[:, :4], box[:, 4]
+    rate = b[:,None,None,2:4] / self.anchors  # anchors.shape=(3,3,2), shape=(M,3,3,2)
+    flag = jnp.maximum(rate, 1.0 / rate).max(-1) < self.aspect_ratio_thre  # shape=(M,3,3)
+    flag = flag & (jnp.arange(M) < nb)[:,None,None]
+    # The candidates (box, offset, anchor) are written in this order, the last valid one wins
+    order = jnp.arange(M * 5 * 3)
+    target = []
+    for j in range(3):  # diff scale
+      s = 2 ** (j+3)
+      A, H, W = p[j].shape[:3]
+      cs = (self.offset + b[:,None,:2] / s).astype(jnp.int32)  # center in cells, shape=(M,5,2)
+      cs = jnp.where(cs < 0, cs + jnp.array([W, H]), cs)  # same as the negative index
+      inside = ((cs >= 0) & (cs < jnp.array([W, H]))).all(-1)  # out of grid is dropped
+      valid = flag[:,None,j,:] & inside[...,None]  # shape=(M,5,3)
+      idx = jnp.arange(3) * H * W + (cs[...,1] * W + cs[...,0])[...,None]  # shape=(M,5,3)
+      idx = jnp.where(valid, idx, A * H * W).reshape(-1)
+      winner = jnp.full(A * H * W, -1).at[idx].max(order, mode='drop')  # the only scatter
+      bc = jnp.concatenate([b[:,None,:2] / s - cs.astype(jnp.float32), jnp.broadcast_to(b[:,None,2:4] / s, (M,5,2))], -1)
+      value = jnp.concatenate([
+        jnp.broadcast_to(bc[:,:,None], (M,5,3,4)),
+        jnp.ones((M,5,3,1)),
+        jnp.broadcast_to(cls[:,None,None,None], (M,5,3,1)),
+      ], -1).reshape(-1, 6)
+      if sparse:
+        K = min(M * 5 * 3, A * H * W)
+        pos = jnp.nonzero(winner >= 0, size=K, fill_value=A * H * W)[0]
+        winner = jnp.where(pos < A * H * W, winner[jnp.minimum(pos, A * H * W - 1)], -1)
+        t = jnp.where(winner[:,None] >= 0, value[jnp.maximum(winner, 0)], 0)
+        target.append((pos, t))
+        continue
+      t = jnp.where(winner[:,None] >= 0, value[jnp.maximum(winner, 0)], 0)
+      target.append(t.reshape(A, H, W, 6))
     return target
   
   @partial(jax.jit, static_argnums=0)
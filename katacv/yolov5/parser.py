@@ -7,6 +7,12 @@ class YOLOv5Args(CVArgs):
   num_classes: int
   use_mosaic4: bool
   num_data_workers: int
+  use_mmap_cache: bool
+  device_augment: bool
+  rect_val: bool
+  bucket_box: bool
+  mosaic_reservoir_Mb: int
+  shm_transport: bool
   ### Augmentation for train ###
   use_mosaic4: bool
   hsv_h: float  # HSV-Hue augmentation
@@ -19,6 +25,7 @@ class YOLOv5Args(CVArgs):
   anchors: List[Tuple[int, int]]
   pretrain_backbone: bool  # whether freeze the BN statistic in backbone
   path_darknet_weights: Path
+  topk: int  # keep the topk boxes by objectness in each scale before NMS, `None` keeps all
   ### Training ###
   accumulate: int  # accumulate the gradient
   use_cosine_decay: bool  # use cosine learning rate decay, else linear decay
@@ -31,6 +38,9 @@ class YOLOv5Args(CVArgs):
   coef_box: float
   coef_obj: float
   coef_cls: float
+  sparse_loss: bool  # box and class losses only on the positive targets
+  ### Validation ###
+  ap_bins: int  # the confidence bins of APAccumulator (default 1000), 0 is the exact AP
 
 def get_args_and_writer(no_writer=False, input_args=None) -> Tuple[YOLOv5Args, SummaryWriter] | YOLOv5Args:
   parser = Parser(model_name="YOLOv5", wandb_project_name=cfg.dataset_name)
@@ -39,6 +49,8 @@ def get_args_and_writer(no_writer=False, input_args=None) -> Tuple[YOLOv5Args, S
     help="the anchors bounding boxes")
   parser.add_argument("--path-darknet-weights", type=cvt2Path, default=cfg.path_darknet_weights,
     help="the path of the CSP-DarkNet53 weights. Pass `None` then starting from scratch.")
+  parser.add_argument("--topk", type=int, default=None,
+    help="if given, the predictor only decodes the top k boxes by objectness in each scale before NMS")
   ### Dataset ###
   parser.add_argument("--path-dataset", type=cvt2Path, default=cfg.path_dataset,
     help="the path of the dataset")
@@ -62,6 +74,18 @@ def get_args_and_writer(no_writer=False, input_args=None) -> Tuple[YOLOv5Args, S
     help="the probability of fliping image left and right augmentation")
   parser.add_argument("--num-data-workers", type=int, default=cfg.num_data_workers,
     help="the number of the subprocesses to use for data loading.")
+  parser.add_argument("--use-mmap-cache", type=str2bool, default=False,
+    help="if taggled, cache the resized images in a memory-mapped file under `path_dataset/cache` (built only once).")
+  parser.add_argument("--device-augment", type=str2bool, default=False,
+    help="if taggled, the data workers only do mosaic, the affine, HSV and flip are jitted on device.")
+  parser.add_argument("--rect-val", type=str2bool, default=False,
+    help="if taggled, the validation images are padded to the rectangle of each batch (sorted by aspect ratio).")
+  parser.add_argument("--bucket-box", type=str2bool, default=False,
+    help="if taggled, the target boxes of each batch are padded to the smallest power-of-two bucket (float32).")
+  parser.add_argument("--mosaic-reservoir-Mb", type=int, default=0,
+    help="the memory size (Mb) of the recently decoded images in each data worker for mosaic partners, 0 is disabled.")
+  parser.add_argument("--shm-transport", type=str2bool, default=False,
+    help="if taggled, the persistent data workers write the batches into shared memory (no tensor pickling).")
   ### Training ###
   parser.add_argument("--total-epochs", type=int, default=cfg.total_epochs,
     help="the total epochs for training")
@@ -83,10 +107,16 @@ def get_args_and_writer(no_writer=False, input_args=None) -> Tuple[YOLOv5Args, S
     help="the coef of the object loss")
   parser.add_argument("--coef-cls", type=float, default=cfg.coef_cls,
     help="the coef of the classification loss")
+  parser.add_argument("--sparse-loss", type=str2bool, default=False,
+    help="if taggled, the box and class losses are only calculated on the gathered positive targets.")
   parser.add_argument("--accumulate", type=str2bool, default=True,
     help="if taggled, accumulate the loss to nominal batch size 64.")
   parser.add_argument("--use-cosine-decay", type=str2bool, default=False,
     help="if taggled, cosine learning rate decay will be used, else use the linear learning rate decay.")
+  ### Validation ###
+  parser.add_argument("--ap-bins", type=int, default=1000,
+    help="the validation AP is accumulated in this number of confidence bins for each class (constant memory, the confidence is rounded down to its bin), \
+      0 keeps all the predicted boxes until the end of validation (exact AP, the memory grows with the validation set).")
   args = parser.get_args(input_args)
   # args.steps_per_epoch = cfg.train_ds_size // args.batch_size
   args.input_shape = (args.batch_size, *args.image_shape)
@@ -5,11 +5,19 @@ from katacv.yolov5.parser import YOLOv5Args
 from katacv.yolov5.train_state import TrainState
 
 class Predictor(BasePredictor):
-  
-  def __init__(self, args: YOLOv5Args, state: TrainState, iout=None, use_bn=True):
-    super().__init__(state, iout, args.image_shape)
+  """
+  Args:
+    topk: If not `None`, only keep the top `topk` boxes by objectness \
+      in each scale before decoding class probability, \
+      that makes NMS only sort `3*topk` candidates.
+    accumulator: The streaming `APAccumulator`, see `BasePredictor`.
+  """
+
+  def __init__(self, args: YOLOv5Args, state: TrainState, iout=None, use_bn=True, topk: int = None, accumulator=None):
+    super().__init__(state, iout, args.image_shape, accumulator)
     self.args = args
     self.use_bn = use_bn
+    self.topk = topk
 
   @partial(jax.jit, static_argnums=0)
   def predict(self, state: TrainState, x: jnp.ndarray):
@@ -21,6 +29,9 @@ class Predictor(BasePredictor):
     )
     y, batch_size = [], x.shape[0]
     for i in range(3):
+      if self.topk is not None:
+        y.append(self.decode_topk(logits[i], i))
+        continue
       xy = (jax.nn.sigmoid(logits[i][...,:2]) - 0.5) * 2.0 + 0.5
       xy = cell2pixel(xy, scale=2**(i+3))
       wh = (jax.nn.sigmoid(logits[i][...,2:4]) * 2) ** 2 * self.args.anchors[i].reshape(1,3,1,1,2)
@@ -31,4 +42,28 @@ class Predictor(BasePredictor):
       y.append(jnp.concatenate([xy,wh,conf,cls], -1).reshape(batch_size,-1,6))
     y = jnp.concatenate(y, 1)  # shape=(batch_size,all_pbox_num,6)
     return y
-  
\ No newline at end of file
+
+  def decode_topk(self, logits: jnp.ndarray, i: int):
+    """
+    Decode the top `self.topk` boxes by objectness in the `i`-th scale.
+
+    Args:
+      logits: The output of the `i`-th scale. [shape=(N,3,H,W,5+nc)]
+      i: The index of the scale, the stride is `2**(i+3)`.
+    Return:
+      y: The decoded boxes. [shape=(N,topk,6), elem:(x,y,w,h,conf,cls)]
+    """
+    N, A, H, W = logits.shape[:4]
+    logits = logits.reshape(N, A*H*W, -1)
+    k = min(self.topk, A*H*W)
+    _, idx = jax.lax.top_k(logits[...,4], k)  # sigmoid is monotonic, shape=(N,k)
+    logits = jnp.take_along_axis(logits, idx[...,None], axis=1)  # shape=(N,k,5+nc)
+    a, h, w = idx // (H*W), idx // W % H, idx % W
+    xy = (jax.nn.sigmoid(logits[...,:2]) - 0.5) * 2.0 + 0.5
+    xy = (xy + jnp.stack([w, h], -1)) * 2**(i+3)
+    wh = (jax.nn.sigmoid(logits[...,2:4]) * 2) ** 2 * self.args.anchors[i][a]
+    conf = jax.nn.sigmoid(logits[...,4:5])
+    cls = jax.nn.sigmoid(logits[...,5:])
+    conf = conf * jnp.max(cls, axis=-1, keepdims=True)
+    cls = jnp.argmax(cls, axis=-1, keepdims=True)
+    return jnp.concatenate([xy,wh,conf,cls], -1)
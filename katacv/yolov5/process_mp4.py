@@ -4,7 +4,7 @@ sys.path.append(os.getcwd())
 from katacv.utils.related_pkgs.jax_flax_optax_orbax import *
 from katacv.utils.related_pkgs.utility import *
 from katacv.yolov5.predict import Predictor
-from katacv.utils.yolo.utils import show_box
+from katacv.utils.yolo.utils import plot_boxes
 
 from PIL import Image
 import numpy as np
@@ -73,8 +73,7 @@ def main(args):
     pbox =  predict(frame)
     SPS_avg += (1/(time.time() - start_time) - SPS_avg) / (idx+1)
 
-    image = show_box(frame, pbox, verbose=False, video=True)
-    processed_frames.append(np.array(image))
+    processed_frames.append(plot_boxes(frame, pbox))
     fps_avg += (1/(time.time() - start_time) - fps_avg) / (idx+1)
     # min_wh = np.minimum(min_wh, pbox[:,[2,3]].min(0))
     # bar.set_description(f"SPS:{SPS_avg:.2f} fps:{fps_avg:.2f} min:{min_wh.round(2)}")
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+@File    : test_loss.py
+@Desc    :
+Compare the vectorized `ComputeLoss.build_target` with the box by box loop of the same writing order,
+and the sparse (positive-only) targets and losses with the dense ones.
+Run: python -m pytest katacv/yolov5/test_loss.py
+'''
+from types import SimpleNamespace
+from functools import partial
+import numpy as np
+import jax, jax.numpy as jnp
+import optax
+import pytest
+
+from katacv.yolov5 import cfg
+from katacv.yolov5.loss import ComputeLoss
+from katacv.yolov5.train_state import TrainState
+
+def get_compute_loss(sparse_loss=False):
+  args = SimpleNamespace(
+    batch_size=4, weight_decay=5e-4, anchors=cfg.anchors, num_classes=80,
+    coef_box=0.05, coef_obj=1.0, coef_cls=0.5, sparse_loss=sparse_loss
+  )
+  return ComputeLoss(args)
+
+def build_target_ref(compute_loss: ComputeLoss, shapes, box, nb):
+  """
+  (Numpy) Write the targets box by box, offset by offset and anchor by anchor, \
+  the later write covers the earlier one, the negative cell index wraps and the cell out of grid is dropped.
+  """
+  anchors, offset = np.asarray(compute_loss.anchors), np.asarray(compute_loss.offset)
+  target = [np.zeros((*shape, 6), np.float32) for shape in shapes]
+  for i in range(nb):
+    b, cls = box[i,:4], box[i,4]
+    rate = b[None,None,2:4] / anchors
+    flag = np.maximum(rate, 1.0 / rate).max(-1) < compute_loss.aspect_ratio_thre  # shape=(3,3)
+    for j in range(3):
+      s = np.float32(2 ** (j+3))
+      A, H, W = shapes[j]
+      for c in (offset + b[:2] / s).astype(np.int32):
+        if not (-W <= c[0] < W and -H <= c[1] < H): continue
+        for k in range(A):
+          if flag[j,k]:
+            target[j][k,c[1],c[0]] = np.r_[b[:2] / s - c.astype(np.float32), b[2:4] / s, 1, cls]
+  return target
+
+def random_box(rng, N, M, size):
+  """Random boxes, with some of them on the edges and some near duplicates (cell collisions)."""
+  xy = rng.uniform(0, size, (N, M, 2))
+  wh = rng.uniform(2, size * 0.6, (N, M, 2))
+  xy[:,:5] = rng.choice([0, size - 0.1, size, size // 2, 8 * 10 + 4], (N, 5, 2))
+  xy[:,5:15] = xy[:,:1] + rng.uniform(-3, 3, (N, 10, 2))
+  xy = np.clip(xy, 0, size)
+  cls = rng.integers(0, 80, (N, M, 1))
+  return np.concatenate([xy, wh, cls], -1).astype(np.float32), rng.integers(0, M + 1, N)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_build_target(seed):
+  rng = np.random.default_rng(seed)
+  N, M, size = 4, 32, 320
+  compute_loss = get_compute_loss()
+  p = [jnp.zeros((N, 3, size // 2 ** j, size // 2 ** j, 85)) for j in range(3, 6)]
+  box, nb = random_box(rng, N, M, size)
+  target = jax.vmap(compute_loss.build_target)(p, box, nb)
+  for n in range(N):
+    ref = build_target_ref(compute_loss, [x.shape[1:4] for x in p], box[n], nb[n])
+    for t, r in zip(target, ref):
+      np.testing.assert_array_equal(np.asarray(t[n]), r)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_build_target_sparse(seed):
+  rng = np.random.default_rng(seed)
+  N, M, size = 4, 32, 320
+  compute_loss = get_compute_loss()
+  p = [jnp.zeros((N, 3, size // 2 ** j, size // 2 ** j, 85)) for j in range(3, 6)]
+  box, nb = random_box(rng, N, M, size)
+  box[0,:3,:2] = 1e4  # out of grid, dropped
+  target = jax.vmap(compute_loss.build_target)(p, box, nb)
+  sparse = jax.vmap(partial(compute_loss.build_target, sparse=True))(p, box, nb)
+  for t, (pos, ts), x in zip(target, sparse, p):
+    A, H, W = x.shape[1:4]
+    pos, ts = np.asarray(pos), np.asarray(ts)
+    assert pos.shape[1] == min(M * 5 * 3, A * H * W)
+    for n in range(N):
+      num = (np.asarray(t[n])[...,4] == 1).sum()
+      np.testing.assert_array_equal(pos[n,num:], A * H * W)  # padding at the end
+      np.testing.assert_array_equal(ts[n,num:], 0)
+      dense = np.zeros((A * H * W + 1, 6), np.float32)
+      dense[pos[n]] = ts[n]
+      np.testing.assert_array_equal(dense[:-1].reshape(A, H, W, 6), np.asarray(t[n]))
+
+def test_sparse_loss():
+  """The logits are the params (identity model), the losses and grads of sparse and dense are the same."""
+  rng = np.random.default_rng(0)
+  N, M, size = 4, 32, 320
+  logits = [jnp.asarray(rng.normal(size=(N, 3, size // 2 ** j, size // 2 ** j, 85)), jnp.float32) for j in range(3, 6)]
+  params = {'logits': logits}
+  tx = optax.sgd(1.0)
+  state = TrainState.create(
+    apply_fn=lambda variables, x, train, mutable: (variables['params']['logits'], {'batch_stats': {}}),
+    params=params, tx=tx, batch_stats={}, grads=jax.tree_util.tree_map(jnp.zeros_like, params),
+    accumulate=100, acc_count=0, tx_bias=tx, ema={'params': params, 'batch_stats': {}}
+  )
+  box, nb = random_box(rng, N, M, size)
+  nb[0] = 0  # an image without target
+  x = jnp.zeros((N, size, size, 3))
+  results = []
+  for sparse_loss in [False, True]:
+    state_new, metrics = get_compute_loss(sparse_loss).step(state, x, box, nb, True)
+    results.append((np.array(metrics), jax.tree_util.tree_leaves(state_new.grads)))
+  (m1, g1), (m2, g2) = results
+  np.testing.assert_allclose(m1, m2, rtol=1e-5)
+  for a, b in zip(g1, g2):
+    np.testing.assert_allclose(np.asarray(a), np.asarray(b), rtol=1e-4, atol=1e-7)
@@ -83,18 +83,40 @@ if __name__ == '__main__':
   
   from katacv.utils.yolo.build_dataset import DatasetBuilder
   ds_builder = DatasetBuilder(args)
-  train_ds = ds_builder.get_dataset(subset='train', use_cache=False)
-  val_ds = ds_builder.get_dataset(subset='val', use_cache=False)
+  train_ds = ds_builder.get_dataset(
+    subset='train', use_cache=args.use_mmap_cache, cache_type='mmap',
+    device_augment=args.device_augment, bucket_box=args.bucket_box,
+    reservoir_Mb=args.mosaic_reservoir_Mb, shm_transport=args.shm_transport
+  )
+  val_ds = ds_builder.get_dataset(
+    subset='val', use_cache=args.use_mmap_cache, cache_type='mmap',
+    rect=args.rect_val, bucket_box=args.bucket_box, shm_transport=args.shm_transport
+  )
   args.max_num_box = train_ds.dataset.max_num_box
 
   ### Build predictor for validation ###
   from katacv.yolov5.predict import Predictor
-  predictor = Predictor(args, state)
+  from katacv.utils.detection.utils_ap import APAccumulator
+  accumulator = APAccumulator(num_iout=10, num_bins=args.ap_bins) if args.ap_bins > 0 else None  # iout=[0.5:0.05:0.95]
+  predictor = Predictor(args, state, topk=args.topk, accumulator=accumulator)
 
   ### Build loss updater for training ###
   from katacv.yolov5.loss import ComputeLoss
   compute_loss = ComputeLoss(args)
 
+  ### Build augmentation on device ###
+  if args.device_augment:
+    from katacv.utils.yolo.augment import augment_batch
+    augment_key = jax.random.PRNGKey(args.seed)
+    augment = partial(
+      augment_batch, hsv=(args.hsv_h, args.hsv_s, args.hsv_v), fliplr=args.fliplr,
+      scale=args.scale, translate=args.translate
+    )
+
+  ### Prefetch batches to device and normalize image x ###
+  from katacv.utils.device_prefetch import DevicePrefetcher, normalize_image
+  normalize = lambda x, tbox, tnum: (normalize_image(x), tbox, tnum)
+
   ### Train and evaluate ###
   start_time, global_step, best_map = time.time(), 0, 0
   if args.train:
@@ -103,9 +125,11 @@ if __name__ == '__main__':
       print(f"epoch: {epoch}/{args.total_epochs}")
       print("training...")
       logs.reset()
-      bar = tqdm(train_ds)
+      bar = tqdm(DevicePrefetcher(train_ds, transform=None if args.device_augment else normalize))
       for x, tbox, tnum in bar:  # Normalize image x !
-        x, tbox, tnum = x.numpy().astype(np.float32) / 255.0, tbox.numpy(), tnum.numpy()
+        if args.device_augment:
+          augment_key, key = jax.random.split(augment_key)
+          x, tbox, tnum = augment(key, x, tbox, tnum)
         global_step += 1
         state, metrics = compute_loss.step(state, x, tbox, tnum, train=True)
         logs.update(
@@ -131,8 +155,7 @@ if __name__ == '__main__':
       print("validating...")
       logs.reset()
       predictor.reset(state=state)
-      for x, tbox, tnum in tqdm(val_ds):
-        x, tbox, tnum = x.numpy().astype(np.float32) / 255.0, tbox.numpy(), tnum.numpy()
+      for x, tbox, tnum in tqdm(DevicePrefetcher(val_ds, transform=normalize)):
         predictor.update(x, tbox, tnum)
         _, metrics = compute_loss.step(state, x, tbox, tnum, train=False)
         logs.update(
@@ -11,6 +11,7 @@ from pathlib import Path
 import time
 from katacv.utils.parser import str2bool
 from katacv.utils.logs import Logs, MeanMetric
+from katacv.utils.device_prefetch import DevicePrefetcher
 path_root = Path(__file__).parents[2]
 
 # Train cmd: python katanlp/miniGPT/train.py --path-dataset /home/yy/Coding/datasets/china_offical_documents --total-epoch 20 --n-embd 768 --n-head 12 --n-block 12 --train-datasize 262114 --val-datasize 16384
@@ -88,9 +89,8 @@ def train():
     print(f"Epoch: {ep+1}/{args.total_epochs}")
     print("Training...")
     logs.reset()
-    bar = tqdm(train_ds)
+    bar = tqdm(DevicePrefetcher(train_ds))
     for x, y in bar:
-      x, y = x.numpy(), y.numpy()
       state, (loss, acc) = gpt.model_step(state, x, y, train=True)
       logs.update(['loss_train', 'acc_train'], [loss, acc])
       bar.set_description(f"loss={loss:.4f}, acc={acc:.4f}")
@@ -102,10 +102,9 @@ def train():
         logs.writer_tensorboard(writer, state.step)
         logs.reset()
     print("Validating...")
-    bar = tqdm(val_ds)
+    bar = tqdm(DevicePrefetcher(val_ds))
     logs.reset()
     for x, y in bar:
-      x, y = x.numpy(), y.numpy()
       _, (loss, acc) = gpt.model_step(state, x, y, train=False)
       logs.update(['loss_val', 'acc_val'], [loss, acc])
       bar.set_description(f"loss={loss:.4f}, acc={acc:.4f}")